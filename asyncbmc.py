@@ -5,38 +5,287 @@ import sys
 import asyncio
 import concurrent.futures
 import time
+import os
 import threading 
 import struct
+import socket
+import random
+import itertools
+import contextvars
+from enum import IntEnum
+from collections import OrderedDict
 #import pyghmi.ipmi.bmc as bmc
 import pyghmi.cmd.fakebmc as fakebmc
 import pyghmi.ipmi.private.serversession as serversession
+import pyghmi.ipmi.private.session as ipmisession
 import pyghmi.ipmi.console as console
 
 AUTH_CONFIG = {'admin': 'changeme'}
 
+RETRANSMIT_CACHE_CONFIG = {
+    "max_entries": 256,
+    "ttl": 10
+}
+
+POWER_STATE_CONFIG = {
+    "ttl": 5,
+    "poll_interval": 2,
+    # statuses that notify their edges are watched instead of polled
+    "edge_detection": True
+}
+
+SOL_CONFIG = {
+    "read_size": 1024,
+    "idle_timeout": 1,
+    "batch_delay": 0.01,
+    "max_pending": 4096,
+    "max_buffered": 16384,
+    "backoff": 0.05
+}
+
+RETRY_BUDGET_CONFIG = {
+    # retries shared by every layer serving one request
+    "retries": 4,
+    # seconds from the start of the request
+    "deadline": 10
+}
+
+CIRCUIT_BREAKER_CONFIG = {
+    # consecutive failures before the target is failed fast
+    "failure_threshold": 3,
+    # seconds before the first probe, doubled for every failed probe
+    "backoff": 1,
+    "max_backoff": 60,
+    "jitter": 0.5
+}
+
+METRICS_CONFIG = {
+    "host": '127.0.0.1',
+    "port": None,
+    "path": None,
+    "dump_interval": 60,
+    "buckets": (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+}
+
 def wait_for_sync(coro, timeout=None, loop=None):
     try:
         if loop is None:
             loop = asyncio.get_event_loop()
 
-        task = asyncio.ensure_future(coro, loop=loop)
         if loop.is_running():
-            return asyncio.run_coroutine_threadsafe(asyncio.wait_for(task, timeout=timeout, loop=loop), loop)
+            # loop belongs to another thread (i.e. the shared runtime), schedule threadsafe
+            return asyncio.run_coroutine_threadsafe(asyncio.wait_for(coro, timeout=timeout, loop=loop), loop)
         else:
+            task = asyncio.ensure_future(coro, loop=loop)
             return loop.run_until_complete(asyncio.wait_for(task, timeout=timeout, loop=loop))
     except Exception as e:
         logging.error(e)
 
+class AsyncRuntime(object):
+    # process-wide event loop shared by every AsyncThreadedObject created without a loop
+    _runtime = None
+    _runtime_lock = threading.Lock()
+
+    def __init__(self, name="asyncbmc-runtime"):
+        self.name = name
+        self.loop = asyncio.new_event_loop()
+        self.loop_thread = threading.Thread(name=self.name, target=self._start_threaded_loop, daemon=True)
+        self.loop_thread.start()
+
+    @classmethod
+    def get_runtime(cls):
+        with cls._runtime_lock:
+            if cls._runtime is None or not cls._runtime.is_running():
+                cls._runtime = cls()
+            return cls._runtime
+
+    def _start_threaded_loop(self):
+        """Switch to runtime event loop and run forever"""
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_forever()
+        finally:
+            self.loop.run_until_complete(self.loop.shutdown_asyncgens())
+            self.loop.close()
+
+    def is_running(self):
+        return self.loop_thread.is_alive() and not self.loop.is_closed()
+
+    def stop(self, timeout=6):
+        if self.is_running():
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            if threading.current_thread() is not self.loop_thread:
+                self.loop_thread.join(timeout)
+
+    def run_coroutine_threadsafe(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+class Metrics(object):
+    # process-wide counters and latency histograms, rendered in the prometheus text format
+    _metrics = None
+    _metrics_lock = threading.Lock()
+
+    def __init__(self, buckets=METRICS_CONFIG['buckets']):
+        self.buckets = tuple(buckets)
+        self.counters: dict = {}
+        self.histograms: dict = {}
+        self.lock = threading.Lock()
+        self.server = None
+
+    @classmethod
+    def get_metrics(cls):
+        with cls._metrics_lock:
+            if cls._metrics is None:
+                cls._metrics = cls()
+            return cls._metrics
+
+    @staticmethod
+    def get_key(labels):
+        return tuple(sorted(labels.items())) if labels else ()
+
+    def inc(self, name, labels=None, value=1):
+        key = self.get_key(labels)
+        with self.lock:
+            series = self.counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+
+    def observe(self, name, value, labels=None):
+        key = self.get_key(labels)
+        with self.lock:
+            series = self.histograms.setdefault(name, {})
+            histogram = series.get(key)
+            if histogram is None:
+                # [per bucket counts..., +Inf count, sum]
+                histogram = series[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    histogram[i] += 1
+                    break
+            else:
+                histogram[len(self.buckets)] += 1
+            histogram[-1] += value
+
+    @staticmethod
+    def format_labels(key, extra=()):
+        labels = ['{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+                  for name, value in tuple(key) + tuple(extra)]
+        return '{' + ','.join(labels) + '}' if labels else ''
+
+    def render(self):
+        with self.lock:
+            counters = {name: dict(series) for name, series in self.counters.items()}
+            histograms = {name: {key: list(histogram) for key, histogram in series.items()} for name, series in self.histograms.items()}
+
+        lines = []
+        for name in sorted(counters):
+            lines.append('# TYPE {} counter'.format(name))
+            for key, value in sorted(counters[name].items()):
+                lines.append('{}{} {}'.format(name, self.format_labels(key), value))
+
+        for name in sorted(histograms):
+            lines.append('# TYPE {} histogram'.format(name))
+            for key, histogram in sorted(histograms[name].items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets + ('+Inf',), histogram):
+                    cumulative += count
+                    lines.append('{}_bucket{} {}'.format(name, self.format_labels(key, (('le', bound),)), cumulative))
+                lines.append('{}_sum{} {}'.format(name, self.format_labels(key), histogram[-1]))
+                lines.append('{}_count{} {}'.format(name, self.format_labels(key), cumulative))
+
+        return '\n'.join(lines) + '\n'
+
+    def dump(self, path):
+        # write then rename so readers never see a partial file
+        tmp_path = '{}.tmp'.format(path)
+        with open(tmp_path, 'w') as f:
+            f.write(self.render())
+        os.replace(tmp_path, path)
+
+    async def dump_periodically(self, path, interval, loop=None):
+        while True:
+            try:
+                self.dump(path)
+            except Exception as e:
+                logging.error(e)
+            await asyncio.sleep(interval, loop=loop)
+
+    async def handle_http(self, reader, writer):
+        try:
+            # any request gets the metrics, read up to the end of the headers
+            while True:
+                line = await reader.readline()
+                if not line or line in (b'\r\n', b'\n'):
+                    break
+            body = self.render().encode('utf8')
+            writer.write(b'HTTP/1.0 200 OK\r\n'
+                         b'Content-Type: text/plain; version=0.0.4\r\n'
+                         + 'Content-Length: {}\r\n\r\n'.format(len(body)).encode('ascii') + body)
+            await writer.drain()
+        except Exception as e:
+            logging.error(e)
+        finally:
+            writer.close()
+
+    async def start_server(self, host=METRICS_CONFIG['host'], port=9623, loop=None):
+        self.server = await asyncio.start_server(self.handle_http, host, port, loop=loop)
+        logging.info("serving metrics on http://%s:%s/metrics", host, port)
+        return self.server
+
+# the budget of the request being served, None for background work
+current_retry_budget = contextvars.ContextVar('current_retry_budget', default=None)
+
+class RetryBudget(object):
+    # one allowance of retries and time per request, consumed by every layer that retries or waits
+    def __init__(self, retries: int = 4, deadline: float = 10):
+        self.retries = retries
+        self.expiry = time.monotonic() + deadline
+
+    @staticmethod
+    def get_current():
+        return current_retry_budget.get()
+
+    @staticmethod
+    def set_current(budget):
+        return current_retry_budget.set(budget)
+
+    @staticmethod
+    def allow_retry(layer):
+        budget = current_retry_budget.get()
+        if budget is None or budget.try_retry():
+            return True
+        logging.debug("retry budget exhausted at %s", layer)
+        Metrics.get_metrics().inc('asyncbmc_retry_budget_exhausted_total', {'layer': layer})
+        return False
+
+    @staticmethod
+    def get_timeout(timeout):
+        # waits end with the request deadline
+        budget = current_retry_budget.get()
+        return timeout if budget is None else min(timeout, budget.remaining_time())
+
+    def remaining_time(self):
+        return max(0, self.expiry - time.monotonic())
+
+    def try_retry(self):
+        if self.retries > 0 and self.remaining_time() > 0:
+            self.retries -= 1
+            return True
+        return False
+
+
 class AsyncThreadedObject(object):
-    def __init__(self, name=None, loop=None):
+    def __init__(self, name=None, loop=None, threaded=False):
         self.name=name
         self.loop = loop
-        self.has_new_loop = self.loop is None
+        # a private loop and thread per object is opt-in only, otherwise attach to the shared runtime
+        self.has_new_loop = self.loop is None and threaded
         self.loop_thread = None
         
         if self.has_new_loop:
             self.loop = asyncio.new_event_loop()
             self.start_loop_thread()
+        elif self.loop is None:
+            self.loop = AsyncRuntime.get_runtime().loop
 
     def __del__(self):
         if self.has_new_loop:
@@ -52,7 +301,7 @@ class AsyncThreadedObject(object):
             self.loop.close()
 
     def _stop_threaded_loop(self):
-        self.loop.stop()
+        self.loop.call_soon_threadsafe(self.loop.stop)
 
     def start_loop_thread(self):
         if self.has_new_loop:
@@ -68,10 +317,10 @@ class AsyncThreadedObject(object):
             # join thread
             if self.loop_thread:
                 self.loop_thread.join(6)
-                logging.debug("loop thread is alive: {}".format(self.loop_thread.isAlive()))
+                logging.debug("loop thread is alive: {}".format(self.loop_thread.is_alive()))
 
     def run_coroutine_threadsafe(self, coro):
-        asyncio.run_coroutine_threadsafe(coro, self.loop)
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
 
 
 class AsyncStatus(AsyncThreadedObject):
@@ -79,11 +328,39 @@ class AsyncStatus(AsyncThreadedObject):
         AsyncThreadedObject.__init__(self, name=name, loop=loop)
         # value
         self.value = value
+        # called with the new value on edges
+        self.subscribers: list = []
 
     async def setup(self):
         # raise NotImplementedError
         await asyncio.sleep(0, loop=self.loop)
 
+    def subscribe(self, callback):
+        if callback not in self.subscribers:
+            self.subscribers.append(callback)
+
+    def unsubscribe(self, callback):
+        if callback in self.subscribers:
+            self.subscribers.remove(callback)
+
+    def notify(self, value: bool):
+        for callback in list(self.subscribers):
+            try:
+                callback(value)
+            except Exception as e:
+                logging.error(e)
+
+    def get_read_age(self):
+        # seconds since the value was last read or pushed, None if not tracked
+        return None
+
+    async def start_edge_detection(self, scheduler: 'AsyncScheduler' = None):
+        # True if changes will be notified to subscribers, otherwise they need to poll
+        return False
+
+    async def stop_edge_detection(self):
+        await asyncio.sleep(0, loop=self.loop)
+
     # set
     async def set_value(self, value: bool):
         # raise NotImplementedError
@@ -95,6 +372,344 @@ class AsyncStatus(AsyncThreadedObject):
         # raise NotImplementedError
         return self.value
 
+    def invalidate(self):
+        # drop anything remembered about value, i.e. in flight reads
+        pass
+
+
+class AsyncSingleFlight(object):
+    # coalesce identical in flight calls so concurrent callers share one result
+    def __init__(self, loop=None):
+        self.loop = loop
+        self.flights: dict = {}
+
+    async def do(self, key, coro_func, *args):
+        future = self.flights.get(key)
+        if future is None:
+            future = asyncio.ensure_future(coro_func(*args), loop=self.loop)
+            self.flights[key] = future
+            future.add_done_callback(lambda f: self._land(key, f))
+        else:
+            logging.debug("joining in flight %s", key)
+        # shield, a cancelled caller must not cancel the flight shared with others
+        return await asyncio.shield(future, loop=self.loop)
+
+    def _land(self, key, future):
+        if self.flights.get(key) is future:
+            del self.flights[key]
+
+    def forget(self, key=None):
+        # later callers start a new flight, current waiters still get theirs
+        if key is None:
+            self.flights.clear()
+        else:
+            self.flights.pop(key, None)
+
+
+class RttEstimator(object):
+    # smoothed round trip time and variance per host and port (Jacobson/Karels), timeouts derived within bounds
+    estimators = {}
+    estimators_lock = threading.Lock()
+
+    ALPHA = 1 / 8
+    BETA = 1 / 4
+    K = 4
+
+    @classmethod
+    def get_estimator(cls, host, port, kind):
+        # a device's command and console ports answer differently
+        key = (host, port, kind)
+        with cls.estimators_lock:
+            if key not in cls.estimators:
+                cls.estimators[key] = cls()
+            return cls.estimators[key]
+
+    def __init__(self):
+        self.srtt = None
+        self.rttvar = None
+        self.backoff = 1
+
+    def observe(self, sample):
+        if self.srtt is None:
+            self.srtt = sample
+            self.rttvar = sample / 2
+        else:
+            self.rttvar = (1 - self.BETA) * self.rttvar + self.BETA * abs(self.srtt - sample)
+            self.srtt = (1 - self.ALPHA) * self.srtt + self.ALPHA * sample
+        self.backoff = 1
+
+    def on_timeout(self):
+        # back off until the next sample, a timed out exchange is no sample
+        self.backoff = min(self.backoff * 2, 64)
+
+    def get_timeout(self, default, minimum, maximum):
+        timeout = default if self.srtt is None else self.srtt + self.K * self.rttvar
+        return min(max(timeout * self.backoff, minimum), maximum)
+
+
+class AsyncCircuitBreaker(AsyncThreadedObject):
+    # fail fast after repeated failures, probe in the background until the target is back
+    class State(IntEnum):
+        CLOSED    = 0
+        OPEN      = 1
+        HALF_OPEN = 2
+
+    def __init__(self, probe=None, config: dict = None, name=None, loop=None):
+        AsyncThreadedObject.__init__(self, name=name, loop=loop)
+        self.config = dict(CIRCUIT_BREAKER_CONFIG)
+        if config is not None:
+            self.config.update(config)
+        # coroutine function returning True once the target is reachable
+        self.probe = probe
+        self.state = AsyncCircuitBreaker.State.CLOSED
+        self.failures = 0
+        self.opens = 0
+        self.probe_task = None
+
+    def is_open(self):
+        # half open only lets the probe through
+        return self.state != AsyncCircuitBreaker.State.CLOSED
+
+    def set_state(self, state: State):
+        if state != self.state:
+            logging.info("circuit breaker %s %s", self.name, state.name)
+            Metrics.get_metrics().inc('asyncbmc_circuit_breaker_transitions_total', {'target': self.name, 'state': state.name})
+        self.state = state
+
+    def record_success(self):
+        self.failures = 0
+        if self.state == AsyncCircuitBreaker.State.CLOSED:
+            return
+        self.reset()
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == AsyncCircuitBreaker.State.CLOSED and self.failures >= self.config['failure_threshold']:
+            self.trip()
+
+    def trip(self):
+        self.opens += 1
+        self.set_state(AsyncCircuitBreaker.State.OPEN)
+        if self.probe is not None and not self.is_probing():
+            self.probe_task = asyncio.ensure_future(self._probe(), loop=self.loop)
+
+    def reset(self):
+        if self.is_probing() and self.probe_task is not asyncio.current_task(loop=self.loop):
+            self.probe_task.cancel()
+        self.probe_task = None
+        self.failures = 0
+        self.opens = 0
+        self.set_state(AsyncCircuitBreaker.State.CLOSED)
+
+    def is_probing(self):
+        return self.probe_task is not None and not self.probe_task.done()
+
+    def get_backoff(self):
+        backoff = min(self.config['backoff'] * 2 ** (self.opens - 1), self.config['max_backoff'])
+        # jittered, probes of targets that failed together spread out
+        return backoff * random.uniform(1 - self.config['jitter'], 1 + self.config['jitter'])
+
+    async def _probe(self):
+        RetryBudget.set_current(None)
+        while self.state != AsyncCircuitBreaker.State.CLOSED:
+            await asyncio.sleep(self.get_backoff(), loop=self.loop)
+            self.set_state(AsyncCircuitBreaker.State.HALF_OPEN)
+            try:
+                is_reachable = await self.probe()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.debug("probe %s failed: %s", self.name, e)
+                is_reachable = False
+
+            if is_reachable:
+                self.reset()
+            elif self.state == AsyncCircuitBreaker.State.HALF_OPEN:
+                self.opens += 1
+                self.set_state(AsyncCircuitBreaker.State.OPEN)
+
+
+class AsyncScheduler(AsyncThreadedObject):
+    # per target queue of hardware operations, run one at a time, most urgent first
+    class Priority(IntEnum):
+        POWER       = 0
+        STATUS      = 1
+        MAINTENANCE = 2
+        BACKGROUND  = 3
+
+    def __init__(self, name=None, loop=None):
+        AsyncThreadedObject.__init__(self, name=name, loop=loop)
+        self.queue = asyncio.PriorityQueue(loop=self.loop)
+        self.queued: dict = {}
+        self.sequence = itertools.count()
+        self.worker_task = None
+        self.running_task = None
+
+    async def submit(self, priority: Priority, coro_func, *args, key=None):
+        if self.running_task is not None and asyncio.current_task(loop=self.loop) is self.running_task:
+            # nested in the running operation, i.e. a power action reading back the power state
+            return await coro_func(*args)
+
+        # operations with a key, i.e. reads, are coalesced while queued
+        future = self.queued.get(key) if key is not None else None
+        if future is None:
+            future = self.loop.create_future()
+            if key is not None:
+                self.queued[key] = future
+            # the operation runs in the context of its submitter
+            self.queue.put_nowait((priority, next(self.sequence), contextvars.copy_context(), coro_func, args, key, future))
+            self.start()
+        else:
+            logging.debug("coalescing queued %s", key)
+
+        return await asyncio.shield(future, loop=self.loop)
+
+    def is_running(self):
+        return self.worker_task is not None and not self.worker_task.done()
+
+    def start(self):
+        if not self.is_running():
+            self.worker_task = asyncio.ensure_future(self._work(), loop=self.loop)
+
+    def stop(self):
+        if self.is_running():
+            self.worker_task.cancel()
+        if self.running_task is not None:
+            self.running_task.cancel()
+        while not self.queue.empty():
+            future = self.queue.get_nowait()[-1]
+            future.cancel()
+        self.queued.clear()
+
+    async def _work(self):
+        while True:
+            priority, _, context, coro_func, args, key, future = await self.queue.get()
+            if key is not None and self.queued.get(key) is future:
+                del self.queued[key]
+            if future.done():
+                continue
+
+            task = self.running_task = context.run(self.loop.create_task, coro_func(*args))
+            try:
+                await asyncio.wait([task], loop=self.loop)
+            except asyncio.CancelledError:
+                # stopped while running, its submitter must not wait forever
+                future.cancel()
+                raise
+            finally:
+                self.running_task = None
+
+            if not future.done():
+                if task.cancelled():
+                    future.cancel()
+                elif task.exception() is not None:
+                    future.set_exception(task.exception())
+                else:
+                    future.set_result(task.result())
+
+
+class AsyncCachedStatus(AsyncStatus):
+    def __init__(self, status: AsyncStatus, ttl: float = 5, poll_interval: float = None, value: bool = False, 
+                 scheduler: AsyncScheduler = None, name=None, loop=None):
+        AsyncStatus.__init__(self, value=value, name=name, loop=loop)
+        self.status = status
+        self.ttl = ttl
+        self.poll_interval = poll_interval
+        self.scheduler = scheduler
+        self.timestamp = None
+        self.poll_task = None
+        self.is_watching = False
+
+    def age(self):
+        return None if self.timestamp is None else self.loop.time() - self.timestamp
+
+    def is_stale(self):
+        age = self.age()
+        if age is None:
+            return True
+        if self.is_watching:
+            # a watched status stays fresh while it keeps reading or pushing edges, not once it has gone quiet
+            read_age = self.status.get_read_age()
+            if read_age is not None:
+                age = min(age, read_age)
+        return age > self.ttl
+
+    def invalidate(self):
+        # next get_value reads through to the status
+        self.timestamp = None
+        self.status.invalidate()
+
+    def update(self, value: bool):
+        if value != self.value and self.timestamp is not None:
+            logging.debug("status %s changed to %s", self.name, value)
+        self.value = value
+        self.timestamp = self.loop.time()
+        return self.value
+
+    async def refresh(self):
+        if self.scheduler is not None:
+            # reads wait behind power actions on the target, queued refreshes are coalesced
+            return await self.scheduler.submit(AsyncScheduler.Priority.STATUS, self._refresh, key=(id(self), 'refresh'))
+        return await self._refresh()
+
+    async def _refresh(self):
+        value = await self.status.get_value()
+        return self.update(value)
+
+    # set
+    async def set_value(self, value: bool):
+        self.invalidate()
+        return await self.status.set_value(value)
+
+    # get
+    async def get_value(self):
+        if self.timestamp is not None:
+            if not self.is_stale():
+                return self.value
+            elif self.is_polling():
+                # the poller owns refreshing, answer from memory
+                logging.debug("stale status %s, age %.2fs", self.name, self.age())
+                return self.value
+        return await self.refresh()
+
+    async def start_watching(self):
+        # subscribe to edges of the status, polling is only needed without them
+        if not self.is_watching:
+            self.status.subscribe(self.update)
+            self.is_watching = await self.status.start_edge_detection(self.scheduler)
+            if not self.is_watching:
+                self.status.unsubscribe(self.update)
+        return self.is_watching
+
+    async def stop_watching(self):
+        if self.is_watching:
+            self.is_watching = False
+            self.status.unsubscribe(self.update)
+            await self.status.stop_edge_detection()
+
+    def is_polling(self):
+        return self.poll_task is not None and not self.poll_task.done()
+
+    def start_polling(self):
+        if self.poll_interval and not self.is_polling():
+            self.poll_task = asyncio.ensure_future(self._poll(), loop=self.loop)
+
+    def stop_polling(self):
+        if self.is_polling():
+            self.poll_task.cancel()
+        self.poll_task = None
+
+    async def _poll(self):
+        RetryBudget.set_current(None)
+        while True:
+            try:
+                await self.refresh()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error(e)
+            await asyncio.sleep(self.poll_interval, loop=self.loop)
+
 
 class AsyncSession(AsyncThreadedObject):
     def __init__(self, name=None, loop=None):
@@ -122,7 +737,7 @@ class AsyncSession(AsyncThreadedObject):
     async def write(self, command_text):
         raise NotImplementedError
     
-    async def read(self, num):
+    async def read(self, num, timeout=None):
         raise NotImplementedError
 
     async def readline(self):
@@ -150,9 +765,16 @@ class AsyncSessionProxy(AsyncThreadedObject):
         AsyncThreadedObject.__init__(self, name=name, loop=loop)
         self.lastdata = None
         self.lastcode = None
+        self.timestamp = time.monotonic()
         self.session: serversession.ServerSession = session
         self._sol_handler = None
 
+        # snapshot the request header, the session may take new requests before a dispatched response is sent
+        self.seqlun = getattr(session, 'seqlun', None)
+        self.clientaddr = getattr(session, 'clientaddr', None)
+        self.clientnetfn = getattr(session, 'clientnetfn', None)
+        self.clientcommand = getattr(session, 'clientcommand', None)
+
     @property
     def sol_handler(self):
         # return self.session.sol_handler
@@ -171,24 +793,18 @@ class AsyncSessionProxy(AsyncThreadedObject):
                                retry=None, delay_xmit=None, timeout=None):
         self.lastdata = data
         self.lastcode = code
+        self.timestamp = time.monotonic()
         if self.session is not None:
-            logging.info('''IPMI Response :
-                              localsid: {}
-                        sequencenumber: {}
-                               timeout: {}
-                                 netfn: {}
-                               command: {}
-                                  data: {}
-                                  code: {}
-                        '''.format(
-                            self.session.localsid,
-                            self.session.sequencenumber,
-                            self.session.timeout,
-                            str(self.session.clientnetfn if not netfn else netfn),
-                            str(self.session.clientcommand if not command else command),
-                            bytes(data).hex(),
-                            str(code)
-                            ))
+            netfn = self.clientnetfn if netfn is None else netfn
+            command = self.clientcommand if command is None else command
+            if self.seqlun is not None:
+                self.session.seqlun = self.seqlun
+            if self.clientaddr is not None:
+                self.session.clientaddr = self.clientaddr
+            if logging.getLogger().isEnabledFor(logging.DEBUG):
+                logging.debug("ipmi response sid=%s seq=%s netfn=%s cmd=%s code=%s data=%s",
+                              self.session.localsid, self.session.sequencenumber, netfn, command, code, bytes(data).hex())
+            Metrics.get_metrics().inc('asyncbmc_ipmi_responses_total', {'netfn': netfn, 'command': command, 'code': code})
             self.session._send_ipmi_net_payload(netfn=netfn, command=command, data=data, code=code,
                                                 bridge_request=bridge_request,
                                                 retry=retry, delay_xmit=delay_xmit, timeout=timeout)
@@ -220,9 +836,259 @@ class AsyncSessionProxy(AsyncThreadedObject):
     def unregister_keepalive(self, keepaliveid):
         self.session.unregister_keepalive(keepaliveid)
 
-class AsyncBmc(fakebmc.FakeBmc, AsyncThreadedObject):
-    def __init__(self, authdata, name=None, port=623, loop=None):
+class AsyncSessionProxyCache(object):
+    # proxies keyed by request (session, sequence number, ...) so retransmits are answered without re-touching hardware
+    def __init__(self, max_entries: int = 256, ttl: float = 10):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.proxies = OrderedDict()
+        # localsid -> (seqlun, keys), a client has one request outstanding on a session so once its seqlun advances
+        # the earlier answers are done with, the seq wraps every 64 requests and a later identical request must not hit them
+        self.sessions = dict()
+        self.last_sweep = time.monotonic()
+
+    def __len__(self):
+        return len(self.proxies)
+
+    @staticmethod
+    def get_key(request, session):
+        # the ipmi rq seq only has 6 bits, qualify it with the request itself
+        return (session.localsid, getattr(session, 'seqlun', None), 
+                request['netfn'], request['command'], bytes(request.get('data', ())))
+
+    @staticmethod
+    def is_session_alive(session):
+        if session is None or getattr(session, 'broken', False):
+            return False
+        # pyghmi replaces the handler when a client opens a new session from the same address
+        bmc = getattr(session, 'bmc', None)
+        handlers = ipmisession.Session.bmc_handlers.get(getattr(session, 'sockaddr', None))
+        if bmc is None or handlers is None:
+            return True
+        return handlers.get(bmc.port, session) is session
+
+    def is_expired(self, proxy: AsyncSessionProxy, now: float):
+        # in flight requests are kept until answered, a retransmit must not re-run them
+        if proxy.lastcode is None:
+            return not self.is_session_alive(proxy.session)
+        return now - proxy.timestamp > self.ttl or not self.is_session_alive(proxy.session)
+
+    def get(self, key):
+        self.evict()
+        self.advance(key[0], key[1])
+        proxy = self.proxies.get(key)
+        if proxy is not None:
+            self.proxies.move_to_end(key)
+        return proxy
+
+    def add(self, key, proxy: AsyncSessionProxy):
+        self.advance(key[0], key[1])
+        self.sessions[key[0]][1].append(key)
+        self.proxies[key] = proxy
+        self.proxies.move_to_end(key)
+        while len(self.proxies) > self.max_entries:
+            self.proxies.popitem(last=False)
+
+    def advance(self, localsid, seqlun):
+        current = self.sessions.get(localsid)
+        if current is not None and current[0] != seqlun:
+            self.remove_session(localsid)
+            current = None
+        if current is None:
+            self.sessions[localsid] = (seqlun, [])
+
+    def evict(self, force: bool = False):
+        now = time.monotonic()
+        if force or now - self.last_sweep > self.ttl:
+            self.last_sweep = now
+            for key, proxy in list(self.proxies.items()):
+                if self.is_expired(proxy, now):
+                    del self.proxies[key]
+            for localsid, (_, keys) in list(self.sessions.items()):
+                if not any(key in self.proxies for key in keys):
+                    del self.sessions[localsid]
+
+    def remove_session(self, localsid):
+        _, keys = self.sessions.pop(localsid, (None, ()))
+        for key in keys:
+            self.proxies.pop(key, None)
+
+class AsyncIpmiEndpoint(AsyncThreadedObject):
+    # serves the bmc socket from the loop, packets are routed to pyghmi's sessions the way its io thread would
+    MAX_PACKETS_PER_READ = 64
+    # pyghmi services keepalives, retry timeouts, iterwaiters and packets queued for its other sockets
+    # from whoever calls wait_for_rsp, listen no longer loops on it so the endpoint does
+    SERVICE_INTERVAL = 0.5
+
+    def __init__(self, mybmc: fakebmc.FakeBmc, name=None, loop=None):
         AsyncThreadedObject.__init__(self, name=name, loop=loop)
+        self.socket = mybmc.serversocket
+        self.closed = threading.Event()
+        self.is_serving = False
+        self.service_handle = None
+        # wakes pyghmi's io thread, a datagram to our own port could land on another SO_REUSEPORT worker
+        self.wakeup_reader = None
+        self.wakeup_writer = None
+
+    async def start(self):
+        if self.is_serving:
+            return
+        # pyghmi's io thread keeps serving client sessions and wakes itself through iosockets[0], which must not be ours
+        if [sock for sock in ipmisession.iosockets if sock is not self.socket] == []:
+            ipmisession.Session._assignsocket()
+        if self.socket in ipmisession.iosockets:
+            ipmisession.iosockets.remove(self.socket)
+            # break the io thread out of a select still holding our socket, it reads and skips the short wakeup
+            self.wakeup_reader, self.wakeup_writer = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+            ipmisession.iosockets.append(self.wakeup_reader)
+            try:
+                self.wakeup_writer.send(b'\x01')
+            except socket.error as e:
+                logging.warning(e)
+        self.closed.clear()
+        self.loop.add_reader(self.socket, self.on_readable)
+        self.is_serving = True
+        self.schedule_service()
+        logging.info("serving ipmi on port %s from the event loop", self.socket.getsockname()[1])
+
+    def stop(self):
+        if self.is_serving:
+            self.loop.remove_reader(self.socket)
+            ipmisession.iosockets.append(self.socket)
+            self.is_serving = False
+        if self.service_handle is not None:
+            self.service_handle.cancel()
+            self.service_handle = None
+        if self.wakeup_reader is not None:
+            if self.wakeup_reader in ipmisession.iosockets:
+                ipmisession.iosockets.remove(self.wakeup_reader)
+            self.wakeup_reader.close()
+            self.wakeup_writer.close()
+            self.wakeup_reader = self.wakeup_writer = None
+        self.closed.set()
+
+    def schedule_service(self):
+        self.service_handle = self.loop.call_later(self.SERVICE_INTERVAL, self.service)
+
+    def service(self):
+        # what Session.wait_for_rsp(0) does without its wait on pyghmi's io thread, on the loop that owns the sessions
+        Session = ipmisession.Session
+        try:
+            while Session.iterwaiters:
+                Session.iterwaiters.pop()({'success': True})
+            # filled by the io thread for its own sockets, i.e. client sessions
+            while ipmisession.sessionqueue:
+                ipmisession.sessionqueue.popleft().process_pktqueue()
+
+            curtime = ipmisession._monotonic_time()
+            sessionstokeepalive = []
+            with ipmisession.util.protect(ipmisession.KEEPALIVE_SESSIONS):
+                for session, parms in list(Session.keepalive_sessions.items()):
+                    if parms['timeout'] < curtime and not session._isincommand():
+                        parms['timeout'] = ipmisession._monotonic_time() + ipmisession.MAX_IDLE - (random.random() * 4.9)
+                        sessionstokeepalive.append(session)
+            for session in sessionstokeepalive:
+                session._keepalive()
+
+            with ipmisession.util.protect(ipmisession.WAITING_SESSIONS):
+                sessionstodel = [session for session, parms in list(Session.waiting_sessions.items()) if parms['timeout'] < curtime]
+                for session in sessionstodel:
+                    Session.waiting_sessions.pop(session, None)
+            for session in sessionstodel:
+                session._timedout()
+        except Exception as e:
+            logging.error(e)
+        self.schedule_service()
+
+    def recvfrom(self):
+        # pyghmi's senders leave the socket blocking
+        self.socket.setblocking(False)
+        try:
+            return self.socket.recvfrom(3000)
+        except (BlockingIOError, InterruptedError):
+            return None
+        except OSError as e:
+            logging.warning(e)
+            return None
+
+    def on_readable(self):
+        handlers = ipmisession.Session.bmc_handlers
+        myport = self.socket.getsockname()[1]
+        sessions = OrderedDict()
+        for _ in range(self.MAX_PACKETS_PER_READ):
+            rdata = self.recvfrom()
+            if rdata is None:
+                break
+            if len(rdata[0]) < 4:
+                continue
+            if rdata[1] in handlers and myport in handlers[rdata[1]]:
+                # session data
+                relsession = handlers[rdata[1]][myport]
+                relsession.pktqueue.append(rdata + (self.socket, True))
+            elif self.socket in handlers:
+                # sessionless data
+                relsession = handlers[self.socket][0]
+                relsession.pktqueue.append(rdata + (self.socket, False))
+            else:
+                continue
+            sessions[id(relsession)] = relsession
+
+        for relsession in sessions.values():
+            try:
+                relsession.process_pktqueue()
+            except Exception as e:
+                logging.error(e)
+
+class AsyncServerConsole(console.ServerConsole):
+    # ServerConsole waits for each ack in _sendoutput, that would stall the loop the acks arrive on
+    def __init__(self, session, iohandler, force=False, loop=None):
+        self.loop = loop
+        self.retransmit_handle = None
+        # ends with wait_for_rsp(0), on the loop that is a handshake with pyghmi's io thread, no network wait
+        console.ServerConsole.__init__(self, session, iohandler, force=force)
+
+    def _sendoutput(self, output, sendbreak=False):
+        self.myseq += 1
+        self.myseq &= 0xf
+        if self.myseq == 0:
+            self.myseq = 1
+        breakbyte = 0b10000 if sendbreak else 0
+        if isinstance(output, str):
+            output = output.encode('utf8')
+        payload = bytearray((self.myseq, 0, 0, breakbyte)) + output
+        self.lasttextsize = len(output)
+        needskeepalive = self.lasttextsize == 0
+        self.awaitingack = True
+        self.lastpayload = payload
+        self.send_payload(payload, retry=False, needskeepalive=needskeepalive)
+        self.schedule_retransmit(payload, needskeepalive, 5)
+
+    def schedule_retransmit(self, payload, needskeepalive, retries):
+        if self.retransmit_handle is not None:
+            self.retransmit_handle.cancel()
+        # same schedule as ServerConsole, waits grow from 0.5 by a second per retry
+        self.retransmit_handle = self.loop.call_later(5.5 - retries, self._retransmit, payload, needskeepalive, retries)
+
+    def _retransmit(self, payload, needskeepalive, retries):
+        self.retransmit_handle = None
+        if not self.awaitingack or self.lastpayload is not payload or not self.activated:
+            return
+        self.send_payload(payload, retry=False, needskeepalive=needskeepalive)
+        retries -= 1
+        if retries:
+            self.schedule_retransmit(payload, needskeepalive, retries)
+        else:
+            self._print_error('Connection lost')
+
+    def close(self):
+        if self.retransmit_handle is not None:
+            self.retransmit_handle.cancel()
+            self.retransmit_handle = None
+        console.ServerConsole.close(self)
+
+class AsyncBmc(fakebmc.FakeBmc, AsyncThreadedObject):
+    def __init__(self, authdata, name=None, port=623, loop=None, threaded=False):
+        AsyncThreadedObject.__init__(self, name=name, loop=loop, threaded=threaded)
         
         # Auth
         self.authdata = AUTH_CONFIG
@@ -233,9 +1099,64 @@ class AsyncBmc(fakebmc.FakeBmc, AsyncThreadedObject):
         fakebmc.FakeBmc.__init__(self, self.authdata, port=port)
 
         self.power_status: AsyncStatus = None
+        self.power_state_cache: AsyncCachedStatus = None
         self.serial_session: AsyncSerialSession = None
         self.bootdevice = 'default'
-        self.proxies: dict = {}
+        self.proxies = AsyncSessionProxyCache(RETRANSMIT_CACHE_CONFIG['max_entries'], RETRANSMIT_CACHE_CONFIG['ttl'])
+
+        # hand requests to the async loop and respond from there instead of blocking the ipmi listener
+        self.nonblocking_dispatch = True
+
+        # Power State Cache Config, read during setup
+        self.power_state_config = dict(POWER_STATE_CONFIG)
+        self.retry_budget_config = dict(RETRY_BUDGET_CONFIG)
+
+        # serializes hardware operations on this target
+        self.scheduler = AsyncScheduler(name=name, loop=self.loop)
+
+        # set by listen, ipmi packets are then handled on self.loop
+        self.endpoint: AsyncIpmiEndpoint = None
+
+        # SoL streaming config
+        self.sol_config = dict(SOL_CONFIG)
+        # client input, written to the serial session in arrival order by a single task
+        self.sol_input: asyncio.Queue = None
+        self.sol_input_task = None
+
+    def is_loop_thread(self):
+        try:
+            return asyncio.get_running_loop() is self.loop
+        except RuntimeError:
+            return False
+
+    def dispatch(self, coro):
+        if self.nonblocking_dispatch and self.is_loop_thread():
+            # already on the loop (i.e. served by the endpoint), no threadsafe hop
+            future = asyncio.ensure_future(coro, loop=self.loop)
+            future.add_done_callback(self._dispatch_done)
+            return future
+        if self.nonblocking_dispatch and self.loop.is_running():
+            future = asyncio.run_coroutine_threadsafe(coro, self.loop)
+            future.add_done_callback(self._dispatch_done)
+            return future
+        # loop is not running (i.e. not yet started by the caller), fall back to blocking
+        return wait_for_sync(coro, loop=self.loop)
+
+    def _dispatch_done(self, future):
+        if not future.cancelled() and future.exception() is not None:
+            logging.error(future.exception())
+
+    def listen(self, timeout=30, native=True):
+        if not native:
+            # pyghmi's io thread reads the socket and handles packets on the listening thread
+            return fakebmc.FakeBmc.listen(timeout)
+        self.endpoint = AsyncIpmiEndpoint(self, name=self.name, loop=self.loop)
+        if self.loop.is_running():
+            asyncio.run_coroutine_threadsafe(self.endpoint.start(), self.loop).result()
+            self.endpoint.closed.wait()
+        else:
+            self.loop.run_until_complete(self.endpoint.start())
+            self.loop.run_forever()
 
     async def setup_power_status(self):
         raise NotImplementedError
@@ -243,11 +1164,38 @@ class AsyncBmc(fakebmc.FakeBmc, AsyncThreadedObject):
     async def setup_serial_session(self):
         raise NotImplementedError
 
+    async def setup_power_state_cache(self):
+        if self.power_state_cache is not None:
+            self.power_state_cache.stop_polling()
+            await self.power_state_cache.stop_watching()
+            self.power_state_cache = None
+
+        if self.power_status is not None:
+            self.power_state_cache = AsyncCachedStatus(self.power_status, 
+                                                       self.power_state_config['ttl'], 
+                                                       self.power_state_config['poll_interval'], 
+                                                       scheduler=self.scheduler,
+                                                       name=self.name, loop=self.loop)
+            if not (self.power_state_config['edge_detection'] and await self.power_state_cache.start_watching()):
+                self.power_state_cache.start_polling()
+
+    def invalidate_power_state(self):
+        # our own power control actions make any cached state stale
+        if self.power_state_cache is not None:
+            self.power_state_cache.invalidate()
+
     async def setup(self):
         # raise NotImplementedError
         await self.setup_power_status()
+        await self.setup_power_state_cache()
         await self.setup_serial_session()
 
+    async def teardown(self):
+        if self.power_state_cache is not None:
+            self.power_state_cache.stop_polling()
+            await self.power_state_cache.stop_watching()
+        self.scheduler.stop()
+
     async def async_power_off(self):
         raise NotImplementedError
 
@@ -305,7 +1253,13 @@ class AsyncBmc(fakebmc.FakeBmc, AsyncThreadedObject):
         except NotImplementedError:
             session.send_ipmi_response(code=0xcc)
 
+    def is_available(self):
+        # False while the target is known to be unreachable, chassis requests are answered immediately
+        return True
+
     async def async_handle_raw_request(self, request, session):
+        # bounds the retries and waits of every layer below, the request runs in its own task
+        RetryBudget.set_current(RetryBudget(**self.retry_budget_config))
         try:
             if request['netfn'] == 6 or request['netfn'] == 24:
                 if request['command'] == 1:  # get device id
@@ -317,12 +1271,15 @@ class AsyncBmc(fakebmc.FakeBmc, AsyncThreadedObject):
                 elif request['command'] == 73:  # deactivate payload
                     return self.deactivate_payload(request, session)
             elif request['netfn'] == 0:
-                if request['command'] == 1:  # get chassis status
+                if not self.is_available():
+                    # Node Busy
+                    return session.send_ipmi_response(code=0xc0)
+                elif request['command'] == 1:  # get chassis status
                     # return self.get_chassis_status(session)
                     return await self.async_get_chassis_status(session)
                 elif request['command'] == 2:  # chassis control
                     # return self.control_chassis(request, session)
-                    return await self.async_control_chassis(request, session)
+                    return await self.scheduler.submit(AsyncScheduler.Priority.POWER, self.async_control_chassis, request, session)
                 elif request['command'] == 8:  # set boot options
                     return self.set_system_boot_options(request, session)
                 elif request['command'] == 9:  # get boot options
@@ -360,20 +1317,20 @@ class AsyncBmc(fakebmc.FakeBmc, AsyncThreadedObject):
 
     def handle_raw_request(self, request, session):
         try:
-            if session.localsid not in self.proxies:
-                logging.debug("proxying session {}".format(session.localsid))
+            key = self.proxies.get_key(request, session)
+            proxy = self.proxies.get(key)
+            if proxy is None:
+                logging.debug("proxying session %s", session.localsid)
                 proxy = AsyncSessionProxy(session, loop=self.loop)
-                self.proxies[session.localsid] = proxy
+                self.proxies.add(key, proxy)
                 #coro = self.keep_alive_during_request(request, proxy)
                 coro = self.async_handle_raw_request(request, proxy)
-                wait_for_sync(coro, loop=self.loop)
+                self.dispatch(coro)
+            elif proxy.lastcode is not None:
+                logging.debug("using cached response for retransmit on session %s", session.localsid)
+                proxy.send_ipmi_response(data=proxy.lastdata, code=proxy.lastcode)
             else:
-                proxy = self.proxies[session.localsid]
-                if proxy.lastcode is not None:
-                    logging.debug("using cached session response {}".format(session.localsid))
-                    session.send_ipmi_response(data=proxy.lastdata, code=proxy.lastcode)
-                else:
-                    logging.debug("skipping duplicate session {}".format(session.localsid))
+                logging.debug("skipping retransmit of in flight request on session %s", session.localsid)
         except NotImplementedError:
             session.send_ipmi_response(code=0xc1)
         except Exception as e:
@@ -390,26 +1347,41 @@ class AsyncBmc(fakebmc.FakeBmc, AsyncThreadedObject):
         logging.info('re-performing setup to BMC cold reset request')
         # Reset of the BMC, not managed system, here we will exit the demo
         #sys.exit(0)
-        wait_for_sync(self.setup(), loop=self.loop)
+        self.dispatch(self.scheduler.submit(AsyncScheduler.Priority.MAINTENANCE, self.setup))
+        return 0
 
         # directive 4
     def pulse_diag(self):
         raise NotImplementedError
 
     async def async_get_power_state(self):
-        logging.info('checking power status')
-        if self.power_status is not None:
+        logging.debug('checking power status')
+        start = time.monotonic()
+        if self.power_state_cache is not None:
+            powerstate = await self.power_state_cache.get_value()
+            self.powerstate = int(powerstate)
+        elif self.power_status is not None:
             powerstate = await self.power_status.get_value()
             self.powerstate = int(powerstate)
         else:
             logging.warning("power_status is None!")
 
+        Metrics.get_metrics().observe('asyncbmc_power_state_seconds', time.monotonic() - start, {'bmc': self.name})
         return self.powerstate
 
     def get_power_state(self):
-        coro = self.async_get_power_state()
-        powerstate = wait_for_sync(coro, loop=self.loop)
-        return powerstate
+        cache = self.power_state_cache
+        if cache is not None and not cache.is_stale():
+            # recent enough to answer without touching the hardware
+            return int(cache.value)
+        if self.is_loop_thread():
+            # the loop can't wait on itself, answer with the last known state and refresh it in the background
+            self.dispatch(self.async_get_power_state())
+            return self.powerstate
+        if self.loop.is_running():
+            # a stale or never read state is refreshed before answering
+            return self.run_coroutine_threadsafe(self.async_get_power_state()).result()
+        return wait_for_sync(self.async_get_power_state(), loop=self.loop)
 
     def is_active(self):
         # return self.powerstate == 'on'>	asyncbmc.get_power_state : 161	Python
@@ -421,32 +1393,106 @@ class AsyncBmc(fakebmc.FakeBmc, AsyncThreadedObject):
         if data:
             if self.serial_session:
                 try:
-                    string = data.decode('utf-8')
-                    await self.serial_session.write(string)
+                    # sessions take the raw bytes, text sessions decode on write
+                    await self.serial_session.write(data)
+                    Metrics.get_metrics().inc('asyncbmc_sol_bytes_total', {'bmc': self.name, 'direction': 'in'}, len(data))
                 except Exception as e:
                     logging.error(e)
         return True
 
 
     def iohandler(self, data):
-        coro = self.async_iohandler(data)
-        return wait_for_sync(coro, loop=self.loop)
+        if self.nonblocking_dispatch and self.loop.is_running():
+            # a task per chunk could reorder keystrokes, queue them for one writer instead
+            if self.is_loop_thread():
+                self.queue_sol_input(data)
+            else:
+                self.loop.call_soon_threadsafe(self.queue_sol_input, data)
+            return True
+        return wait_for_sync(self.async_iohandler(data), loop=self.loop)
+
+    def queue_sol_input(self, data):
+        if self.sol_input is None:
+            self.sol_input = asyncio.Queue(loop=self.loop)
+        self.sol_input.put_nowait(data)
+        if self.sol_input_task is None or self.sol_input_task.done():
+            self.sol_input_task = asyncio.ensure_future(self._write_sol_input(self.sol_input), loop=self.loop)
+
+    def stop_sol_input(self):
+        if self.sol_input_task is not None:
+            self.sol_input_task.cancel()
+            self.sol_input_task = None
+        self.sol_input = None
+
+    async def _write_sol_input(self, sol_input: asyncio.Queue):
+        while True:
+            data = await sol_input.get()
+            await self.async_iohandler(data)
+
+    @staticmethod
+    def get_sol_backlog(sol):
+        # bytes queued in the console waiting on client acks, read without outputlock which is held while awaiting an ack
+        return sum(len(output) for output in list(sol.pendingoutput) if not isinstance(output, dict))
 
     async def _poll_serial(self):
         logging.debug("Entering serial poll")
-        
+        # outlives the request that activated it
+        RetryBudget.set_current(None)
+        config = self.sol_config
+        buffer = bytearray()
+        sending = None
+        idle = None
+        # ServerConsole.send_data blocks until the client acks, keep it off the loop on a single ordered sender
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
         while self.serial_session and self.activated:
-            logging.debug("polling serial...")
-            await asyncio.sleep(0)
+            sol = self.sol
+            if sol is None:
+                break
+
+            # hand everything read while the previous send was in flight to the console, it splits into maxoutcount packets
+            if buffer and (sending is None or sending.done()) and self.get_sol_backlog(sol) < config['max_pending']:
+                if isinstance(sol, AsyncServerConsole):
+                    # acks are handled on this loop, send_data does not wait for them
+                    sol.send_data(bytes(buffer))
+                else:
+                    sending = self.loop.run_in_executor(executor, sol.send_data, bytes(buffer))
+                Metrics.get_metrics().inc('asyncbmc_sol_bytes_total', {'bmc': self.name, 'direction': 'out'}, len(buffer))
+                del buffer[:]
+
+            if len(buffer) >= config['max_buffered']:
+                # client is behind, stop reading and let the serial data back up in the socket
+                await asyncio.sleep(config['backoff'], loop=self.loop)
+                continue
+
             try:
-                string = await self.serial_session.read(1024)
-                if string:
-                    data = bytearray(string, 'utf8')
-                    if self.sol and data:
-                        self.sol.send_data(data)
+                data = await self.serial_session.read(config['read_size'], 
+                                                      timeout=config['batch_delay'] if buffer else config['idle_timeout'])
+            except asyncio.TimeoutError:
+                if not buffer and not idle:
+                    idle = True
+                    logging.debug("serial idle")
+                continue
             except Exception as e:
                 logging.error(e)
-        
+                await asyncio.sleep(config['backoff'], loop=self.loop)
+                continue
+
+            if not data:
+                # not connected or eof
+                await asyncio.sleep(config['backoff'], loop=self.loop)
+                continue
+
+            if idle is not False:
+                idle = False
+                logging.debug("serial streaming")
+
+            buffer.extend(data if isinstance(data, (bytes, bytearray)) else data.encode('utf8'))
+
+        if sending is not None:
+            await asyncio.wait([sending], loop=self.loop)
+        executor.shutdown(wait=False)
+
         # disconnect
         await self.serial_session.disconnect()
         logging.debug("Exiting serial poll")
@@ -462,7 +1508,10 @@ class AsyncBmc(fakebmc.FakeBmc, AsyncThreadedObject):
             self.activated = True
             solport = list(struct.unpack('BB', struct.pack('!H', self.port)))
             session.send_ipmi_response(data=[0, 0, 0, 0, 1, 0, 1, 0] + solport + [0xff, 0xff])
-            self.sol = console.ServerConsole(session, self.iohandler)
+            if self.endpoint is not None and self.endpoint.is_serving:
+                self.sol = AsyncServerConsole(session, self.iohandler, loop=self.loop)
+            else:
+                self.sol = console.ServerConsole(session, self.iohandler)
             # fire and forget start_shell
             asyncio.ensure_future(self.serial_session.start_shell(self._poll_serial), loop=self.loop) 
             
@@ -475,6 +1524,7 @@ class AsyncBmc(fakebmc.FakeBmc, AsyncThreadedObject):
         else:
             session.send_ipmi_response()
             self.sol.close()
+            self.stop_sol_input()
             self.activated = False
             # fire and forget stop_shell
             asyncio.ensure_future(self.serial_session.stop_shell(), loop=self.loop)
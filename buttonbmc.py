@@ -25,12 +25,15 @@ class Button(asyncbmc.AsyncStatus):
         value = await self.get_value()
         await self.set_value(not value)
         await asyncio.sleep(toggle_duration, loop=self.loop)
+        # presses outlast the request's budget, the release and the readback after it must not be cut short
+        asyncbmc.RetryBudget.set_current(None)
         return await self.set_value(value)
 
     async def press(self, press_duration:int):
         assert press_duration >= 0
         await self.set_value(True)
         await asyncio.sleep(press_duration, loop=self.loop)
+        asyncbmc.RetryBudget.set_current(None)
         return await self.set_value(False)
 
 class ButtonBmc(asyncbmc.AsyncBmc):
@@ -86,6 +89,7 @@ class ButtonBmc(asyncbmc.AsyncBmc):
         if (powerstate != 0 and 
             self.power_button is not None):
             await self.power_button.press(press_duration)
+            self.invalidate_power_state()
             powerstate = await self.async_get_power_state()
         else:
             logging.info('already powered off')
@@ -108,6 +112,7 @@ class ButtonBmc(asyncbmc.AsyncBmc):
         if (powerstate == 0 and 
             self.power_button is not None):
             await self.power_button.press(press_duration)
+            self.invalidate_power_state()
             powerstate = await self.async_get_power_state()
         else:
             logging.info('already powered on')
@@ -153,6 +158,7 @@ class ButtonBmc(asyncbmc.AsyncBmc):
     async def press_power_reset(self, press_duration):
         if self.reset_button is not None:
             await self.reset_button.press(press_duration)
+            self.invalidate_power_state()
         else:
             logging.warning('unable to reset due to no reset_button set')
             # power_cycle
@@ -3,8 +3,9 @@ import logging
 import argparse
 import sys
 import asyncio
+import time
 import pinbmc
-from asyncbmc import AsyncThreadedObject, AsyncSerialSession
+from asyncbmc import AsyncThreadedObject, AsyncSerialSession, Metrics, RetryBudget
 from enum import IntEnum
 from itertools import chain
 
@@ -23,6 +24,25 @@ class Command(AsyncThreadedObject):
         # raise NotImplementedError
         return True
 
+    # pipelining splits execute into send and receive, by default everything happens on receive
+    async def send(self, pipelined: bool = False):
+        await asyncio.sleep(0, loop=self.loop)
+
+    async def receive(self, pipelined: bool = False):
+        return await self.execute()
+
+    async def discard_pending(self):
+        # drop input left on the channel before an exchange, i.e. a late response to a command that timed out
+        await asyncio.sleep(0, loop=self.loop)
+
+    def get_lock(self):
+        # lock serializing exchanges on a shared channel, i.e. a pooled session
+        return None
+
+    def get_target(self):
+        # metrics label for the hardware the command runs against
+        return getattr(self.receiver, "name", None) or type(self.receiver).__name__
+
 class GenericCommand(Command):
     class CommandEnum(IntEnum):
         # Common
@@ -55,28 +75,69 @@ class SerialCommand(GenericCommand):
     #CommandEnum = IntEnum('Idx', [(i.name, i.value) for i in chain(GenericCommand.CommandEnum, SerialCommand.CommandEnum)])
 
 class CommandInvoker(AsyncThreadedObject):
-    def __init__(self, retries:int=2, name=None, loop=None):
+    def __init__(self, retries:int=2, pipelined:bool=False, name=None, loop=None):
         AsyncThreadedObject.__init__(self, name=name, loop=loop)
         self.retries = retries
+        self.pipelined = pipelined
+
+    async def invoke_command(self, command: GenericCommand, tries:int=0):
+        is_handled = False
+        command_name = command.command_enum.name
+        while (not is_handled and tries < self.retries):
+            if tries > 0 and not RetryBudget.allow_retry('command'):
+                break
+            tries += 1
+            logging.debug("Executing Command %s, Attempt %s", command_name, tries)
+            if tries > 1:
+                Metrics.get_metrics().inc('asyncbmc_command_retries_total', {'target': command.get_target(), 'command': command_name})
+            try:
+                is_handled = await self.execute_command(command)
+            except Exception as e:
+                logging.error(e)
+
+            # status
+            logging.debug("Command %s %s", command_name, "Succeeded" if is_handled else "Failed")
+
+        return is_handled
+
+    async def execute_command(self, command: GenericCommand):
+        # handled commands change their enum, label metrics with the one executed
+        command_name = command.command_enum.name
+        start = time.monotonic()
+        is_handled = False
+        try:
+            lock = command.get_lock()
+            if lock is None:
+                await command.discard_pending()
+                is_handled = await command.execute()
+            else:
+                async with lock:
+                    await command.discard_pending()
+                    is_handled = await command.execute()
+        finally:
+            self.observe_command(command, command_name, time.monotonic() - start, is_handled)
+        return is_handled
+
+    @staticmethod
+    def observe_command(command: GenericCommand, command_name, seconds, is_handled):
+        metrics = Metrics.get_metrics()
+        labels = {'target': command.get_target(), 'command': command_name}
+        metrics.observe('asyncbmc_command_seconds', seconds, labels)
+        metrics.inc('asyncbmc_commands_total', dict(labels, result='handled' if is_handled else 'failed'))
 
     async def invoke(self, *commands: GenericCommand):
+        if self.pipelined:
+            results = await self.invoke_pipelined(*commands)
+            return all(results)
+
+        return await self.invoke_sequential(*commands)
+
+    async def invoke_sequential(self, *commands: GenericCommand):
+        # stops at the first failure, later commands are never sent
         all_handled = True
         for command in commands:
             if command is not None:
-                tries = 0
-                is_handled = False
-                command_name = command.command_enum.name
-                while (not is_handled and tries < self.retries):
-                    tries += 1
-                    logging.debug("Executing Command {}, Attempt {}".format(command_name, tries))
-                    try:
-                        is_handled = await command.execute()
-                    except Exception as e:
-                        logging.error(e)
-
-                    # status
-                    logging.debug("Command {} {}".format(command_name, "Succeeded" if is_handled else "Failed"))
-
+                is_handled = await self.invoke_command(command)
                 if not is_handled:
                     all_handled = False
                     break
@@ -85,6 +146,63 @@ class CommandInvoker(AsyncThreadedObject):
 
         return all_handled
 
+    async def _send_receive(self, commands, results):
+        command_names = [command.command_enum.name for command in commands]
+        start = time.monotonic()
+        sent = 0
+        try:
+            # the batch shares one channel, only input from before the batch is stale
+            await commands[0].discard_pending()
+            for command in commands:
+                await command.send(pipelined=True)
+                sent += 1
+        except Exception as e:
+            logging.error(e)
+
+        for i, command in enumerate(commands[:sent]):
+            try:
+                # every response is read up to its end so a failure doesn't leave it to the next command
+                results[i] = await command.receive(pipelined=True)
+            except Exception as e:
+                logging.error(e)
+            # latency of a pipelined command includes waiting behind its predecessors in the batch
+            self.observe_command(command, command_names[i], time.monotonic() - start, results[i])
+
+        return sent
+
+    async def invoke_pipelined(self, *commands: GenericCommand):
+        # write the whole batch back to back, then match the responses in order
+        commands = [command for command in commands if command is not None]
+        command_names = [command.command_enum.name for command in commands]
+        results = [False] * len(commands)
+        sent = 0
+
+        locks = set(command.get_lock() for command in commands)
+        if len(locks) == 1:
+            # hold the channel for the whole batch
+            lock = locks.pop()
+            if lock is None:
+                sent = await self._send_receive(commands, results)
+            else:
+                async with lock:
+                    sent = await self._send_receive(commands, results)
+        else:
+            logging.debug("Pipelined Commands span several channels, executing sequentially")
+
+        # failures fall back to sequential execution with the remaining retries, stopping at the first that still fails
+        for i, command in enumerate(commands):
+            if not results[i]:
+                logging.debug("Pipelined Command %s Failed, Retrying", command_names[i])
+                results[i] = await self.invoke_command(command, tries=1 if i < sent else 0)
+                if not results[i]:
+                    break
+
+        failed = [command_names[i] for i, is_handled in enumerate(results) if not is_handled]
+        if failed:
+            logging.debug("Pipelined Commands Failed: %s", ", ".join(failed))
+
+        return results
+
 class CommandClient(AsyncThreadedObject):
     def __init__(self, receiver, invoker: CommandInvoker=None, name=None, loop=None):
         AsyncThreadedObject.__init__(self, name=name, loop=loop)
@@ -121,7 +239,7 @@ class CommandPin(pinbmc.DigitalPin):
         return await self.pin_command_client.write_logic_level()
 
     async def read_logic_level(self):
-        return await self.pin_command_client.read_logic_level()
+        return await self.single_flight.do('read_logic_level', self.pin_command_client.read_logic_level)
 
     async def setup(self):
         if self.is_valid_pin(self.pin):
@@ -1,7 +1,11 @@
 #!/usr/bin/env python
 import logging
+import asyncio
 import argparse
 import sys
+import re
+import weakref
+import asyncbmc
 import commandbmc
 import telnetbmc
 from enum import IntEnum
@@ -22,6 +26,8 @@ class Esp8266TelnetCommand(telnetbmc.TelnetCommand):
         # Common
         pass
 
+    SENTINEL_REGEX = re.compile(r"\> empty command")
+
     # https://stackoverflow.com/questions/33679930/how-to-extend-python-enum
     #CommandEnum = IntEnum('Idx', [(i.name, i.value) for i in chain(telnetbmc.TelnetCommand.CommandEnum, Esp8266TelnetCommand.CommandEnum)])
 
@@ -81,6 +87,12 @@ class Esp8266TelnetPinCommand(telnetbmc.TelnetPinCommand, Esp8266TelnetCommand):
 
         return commands
 
+    def get_template_key(self):
+        pin: Esp8266TelnetCommandPin = self.receiver
+        if pin:
+            return (type(self), pin.pin, pin.is_output, pin.logic_level, pin.needs_autostart())
+        return super().get_template_key()
+
     def get_responses(self):
         responses = super().get_responses()
         pin: Esp8266TelnetCommandPin = self.receiver
@@ -102,6 +114,67 @@ class Esp8266TelnetPinCommand(telnetbmc.TelnetPinCommand, Esp8266TelnetCommand):
 
         return responses
 
+class Esp8266TelnetSnapshotCommand(Esp8266TelnetCommand):
+    class CommandEnum(IntEnum):
+        # Snapshot
+        READ_STATE_SNAPSHOT = 0x2200
+
+    def get_commands(self):
+        commands = super().get_commands()
+        snapshot: Esp8266PinSnapshot = self.receiver
+        if snapshot:
+            commands.update({
+                # im
+                Esp8266TelnetSnapshotCommand.CommandEnum.READ_STATE_SNAPSHOT: "im"
+            })
+
+        return commands
+
+    def get_responses(self):
+        responses = super().get_responses()
+        snapshot: Esp8266PinSnapshot = self.receiver
+        if snapshot:
+            responses.update({
+                # im
+                Esp8266TelnetSnapshotCommand.CommandEnum.READ_STATE_SNAPSHOT: r"pin:\s+(?P<pin>\d+), mode: digital (?P<mode>input|output)\s+\[hw: digital (?:input|output)\s*\] flags: \[[^\]]*\],(?: (?:input|output),)? state: (?P<state>on|off)"
+            })
+
+        return responses
+
+    async def send(self, pipelined: bool = False):
+        if self.command_enum != Esp8266TelnetSnapshotCommand.CommandEnum.READ_STATE_SNAPSHOT:
+            return await super().send(pipelined)
+        # the dump's length depends on the firmware's pin layout, the keep alive sent after it marks its end
+        await super().send(pipelined=True)
+
+    async def receive(self, pipelined: bool = False):
+        if self.command_enum != Esp8266TelnetSnapshotCommand.CommandEnum.READ_STATE_SNAPSHOT:
+            return await super().receive(pipelined)
+
+        snapshot: Esp8266PinSnapshot = self.receiver
+        session = snapshot.command_telnet_session
+        response_regex = self.get_response_regex(self.command_enum)
+        sentinel_regex = self.get_sentinel_regex()
+        try:
+            while True:
+                response_line = await session.readline()
+                if not response_line:
+                    # EOF
+                    break
+                if sentinel_regex.search(response_line):
+                    # every pin the firmware lists is in
+                    if snapshot.states:
+                        self.command_enum = commandbmc.GenericCommand.CommandEnum.HANDLED
+                        return True
+                    break
+                match = response_regex.search(response_line)
+                if match is not None:
+                    snapshot.states[int(match.group('pin'))] = match.group('state')
+        except asyncio.TimeoutError:
+            logging.debug("pin snapshot of host %s timed out", session.host)
+            asyncbmc.Metrics.get_metrics().inc('asyncbmc_telnet_timeouts_total', {'host': session.host})
+        return False
+
 class Esp8266TelnetSerialCommand(telnetbmc.TelnetSerialCommand, Esp8266TelnetCommand):
 
     class CommandEnum(IntEnum):
@@ -166,6 +239,13 @@ class Esp8266TelnetSerialCommand(telnetbmc.TelnetSerialCommand, Esp8266TelnetCom
 
         return commands
 
+    def get_template_key(self):
+        serial: Esp8266TelnetCommandSerial = self.receiver
+        if serial:
+            return (type(self), serial.bridge_port, serial.tx_pin, serial.rx_pin, 
+                    serial.baud_rate, serial.data_bits, serial.stop_bits, serial.parity)
+        return super().get_template_key()
+
     def get_responses(self):
         responses = super().get_responses()
         serial: Esp8266TelnetCommandSerial = self.receiver
@@ -245,7 +325,15 @@ class Esp8266TelnetPinCommandClient(commandbmc.PinCommandClient):
         await self.invoker.invoke(Esp8266TelnetPinCommand(self.receiver, commandbmc.PinCommand.CommandEnum.WRITE_STATE, loop=self.loop))
 
     async def read_logic_level(self):
-        await self.invoker.invoke(Esp8266TelnetPinCommand(self.receiver, commandbmc.PinCommand.CommandEnum.READ_STATE, loop=self.loop))
+        pin: Esp8266TelnetCommandPin = self.receiver
+        snapshot = Esp8266PinSnapshot.get_snapshot(pin.command_telnet_session)
+        if not pin.is_output and snapshot.is_shared():
+            # several pins on the device, one dump reads them all
+            if await snapshot.read() and pin.pin in snapshot.states:
+                return
+        if not await self.invoker.invoke(Esp8266TelnetPinCommand(self.receiver, commandbmc.PinCommand.CommandEnum.READ_STATE, loop=self.loop)):
+            # the level was not read, don't pass the last one off as current
+            raise IOError("reading pin {} of host {} failed".format(pin.pin, pin.command_telnet_session.host))
 
 class Esp8266TelnetSerialCommandClient(commandbmc.SerialCommandClient):
     async def setup(self):
@@ -265,14 +353,15 @@ class Esp8266TelnetSerialCommandClient(commandbmc.SerialCommandClient):
                                                                  Esp8266TelnetSerialCommand(self.receiver, Esp8266TelnetSerialCommand.CommandEnum.VALIDATE_UART_PARITY_CONFIG, loop=self.loop))
                     if not has_valid_config:
                         logging.debug("Unexpected config for serial command host {}!".format(serial.command_telnet_session.host))
-                        await self.invoker.invoke(Esp8266TelnetSerialCommand(self.receiver, Esp8266TelnetSerialCommand.CommandEnum.CONFIG_FLAG_LOG_TO_UART, loop=self.loop),
-                                                  Esp8266TelnetSerialCommand(self.receiver, Esp8266TelnetSerialCommand.CommandEnum.CONFIG_UART_BRIDGE_PORT, loop=self.loop),
-                                                  Esp8266TelnetSerialCommand(self.receiver, Esp8266TelnetSerialCommand.CommandEnum.CONFIG_UART_TX, loop=self.loop),
-                                                  Esp8266TelnetSerialCommand(self.receiver, Esp8266TelnetSerialCommand.CommandEnum.CONFIG_UART_RX, loop=self.loop),
-                                                  Esp8266TelnetSerialCommand(self.receiver, Esp8266TelnetSerialCommand.CommandEnum.CONFIG_UART_BAUD, loop=self.loop),
-                                                  Esp8266TelnetSerialCommand(self.receiver, Esp8266TelnetSerialCommand.CommandEnum.CONFIG_UART_STOP_BITS, loop=self.loop),
-                                                  Esp8266TelnetSerialCommand(self.receiver, Esp8266TelnetSerialCommand.CommandEnum.CONFIG_UART_DATA_BITS, loop=self.loop),
-                                                  Esp8266TelnetSerialCommand(self.receiver, Esp8266TelnetSerialCommand.CommandEnum.CONFIG_UART_PARITY, loop=self.loop))
+                        # config writes stop at the first failure
+                        await self.invoker.invoke_sequential(Esp8266TelnetSerialCommand(self.receiver, Esp8266TelnetSerialCommand.CommandEnum.CONFIG_FLAG_LOG_TO_UART, loop=self.loop),
+                                                             Esp8266TelnetSerialCommand(self.receiver, Esp8266TelnetSerialCommand.CommandEnum.CONFIG_UART_BRIDGE_PORT, loop=self.loop),
+                                                             Esp8266TelnetSerialCommand(self.receiver, Esp8266TelnetSerialCommand.CommandEnum.CONFIG_UART_TX, loop=self.loop),
+                                                             Esp8266TelnetSerialCommand(self.receiver, Esp8266TelnetSerialCommand.CommandEnum.CONFIG_UART_RX, loop=self.loop),
+                                                             Esp8266TelnetSerialCommand(self.receiver, Esp8266TelnetSerialCommand.CommandEnum.CONFIG_UART_BAUD, loop=self.loop),
+                                                             Esp8266TelnetSerialCommand(self.receiver, Esp8266TelnetSerialCommand.CommandEnum.CONFIG_UART_STOP_BITS, loop=self.loop),
+                                                             Esp8266TelnetSerialCommand(self.receiver, Esp8266TelnetSerialCommand.CommandEnum.CONFIG_UART_DATA_BITS, loop=self.loop),
+                                                             Esp8266TelnetSerialCommand(self.receiver, Esp8266TelnetSerialCommand.CommandEnum.CONFIG_UART_PARITY, loop=self.loop))
                 else:
                     logging.warn("No connection available for serial host {}!".format(serial.command_telnet_session.host))
 
@@ -284,12 +373,57 @@ class Esp8266TelnetSerialCommandClient(commandbmc.SerialCommandClient):
         # raise NotImplementedError
         pass
 
+class Esp8266PinSnapshot(telnetbmc.TelnetCommandReceiver):
+    # reads the state of every pin bound to a device's command session in one exchange
+    def __init__(self, command_telnet_session: telnetbmc.TelnetSession, loop=None):
+        telnetbmc.TelnetCommandReceiver.__init__(self, command_telnet_session)
+        self.loop = loop
+        self.pins = weakref.WeakSet()
+        self.states: dict = {}
+        self.invoker = commandbmc.CommandInvoker(retries=2, loop=self.loop)
+        self.single_flight = asyncbmc.AsyncSingleFlight(loop=self.loop)
+
+    @classmethod
+    def get_snapshot(cls, command_telnet_session: telnetbmc.TelnetSession):
+        # one per pooled session, shared by every pin read over it
+        if command_telnet_session.pin_snapshot is None:
+            command_telnet_session.pin_snapshot = cls(command_telnet_session, loop=command_telnet_session.loop)
+        return command_telnet_session.pin_snapshot
+
+    def add_pin(self, pin: 'Esp8266TelnetCommandPin'):
+        # output levels are ours to set, a dump finishing during a button press must not overwrite them
+        if not pin.is_output:
+            self.pins.add(pin)
+
+    def is_shared(self):
+        # more than one input pin to read, otherwise a single 'ir' is cheaper than the dump
+        return len(self.pins) > 1
+
+    async def read(self):
+        # concurrent reads of any pin on the device share one dump
+        return await self.single_flight.do('read', self._read)
+
+    async def _read(self):
+        self.states = {}
+        is_handled = await self.invoker.invoke(Esp8266TelnetSnapshotCommand(self, Esp8266TelnetSnapshotCommand.CommandEnum.READ_STATE_SNAPSHOT, loop=self.loop))
+        if is_handled:
+            # fan out to the input pins, their subscribers see the changes
+            for pin in list(self.pins):
+                state = self.states.get(pin.pin)
+                if state is not None:
+                    pin.on_edge(pin.state_to_logic_level(state))
+        return is_handled
+
+
 class Esp8266TelnetCommandPin(telnetbmc.TelnetCommandPin):
     ON_STATE = "on"
     OFF_STATE = "off"
+    # the firmware can't push pin changes over the command session, watching is a poll of single pin reads at the old poller's rate
+    WATCH_INTERVAL = 2
 
     async def setup_pin_command_client(self):
         self.pin_command_client = Esp8266TelnetPinCommandClient(self, invoker=None, loop=self.loop)
+        Esp8266PinSnapshot.get_snapshot(self.command_telnet_session).add_pin(self)
         await self.pin_command_client.setup()
 
     def get_true_logic_level(self):
@@ -302,7 +436,7 @@ class Esp8266TelnetCommandPin(telnetbmc.TelnetCommandPin):
         return self.ON_STATE if logic_level == self.get_true_logic_level() else self.OFF_STATE
 
     def state_to_logic_level(self, state: str):
-        return self.get_true_logic_level() if state is self.ON_STATE else self.get_false_logic_level()
+        return self.get_true_logic_level() if state == self.ON_STATE else self.get_false_logic_level()
 
     def needs_autostart(self):
         logic_level = self.value_to_logic_level(self.initial_value)
@@ -321,7 +455,9 @@ class Esp8266TelnetCommandSerial(telnetbmc.TelnetCommandSerial):
         self.parity = parity_bits
 
     async def setup_serial_command_client(self):
-        self.serial_command_client = Esp8266TelnetSerialCommandClient(self, invoker=None, loop=self.loop)
+        # uart validation and config are sent as pipelined batches, one round trip per batch
+        invoker = commandbmc.CommandInvoker(retries=2, pipelined=True, loop=self.loop)
+        self.serial_command_client = Esp8266TelnetSerialCommandClient(self, invoker=invoker, loop=self.loop)
         await self.serial_command_client.setup()
 
 class Esp8266Bmc(telnetbmc.TelnetBmc):
@@ -0,0 +1,364 @@
+#!/usr/bin/env python
+import logging
+import argparse
+import sys
+import asyncio
+import random
+
+'''
+Emulates the ESP8266 Universal IO Bridge (https://github.com/eriksl/esp8266-universal-io-bridge) command and uart bridge ports,
+answering with the response formats esp8266bmc expects, with configurable latency, jitter, dropped responses and disconnects
+'''
+
+EMULATOR_CONFIG = {
+    "host": '127.0.0.1',
+    "command_port": 24,
+    "bridge_port": 23,
+    # fault injection, applied per command
+    "latency": 0,
+    "jitter": 0,
+    "drop_rate": 0,
+    "disconnect_rate": 0,
+    "seed": None,
+    # attached machine, its power status toggles when the power button is released
+    "power_pin": 0,
+    "status_pin": 2,
+    "power_active_level": 0,
+    # generated console output on the uart bridge in bytes/s, throttled to the baud rate
+    "console_rate": 0
+}
+
+UART_EMULATOR_CONFIG = {
+    "baud_rate": 115200,
+    "data_bits": 8,
+    "stop_bits": 1,
+    "parity": "none"
+}
+
+# gpios usable on the esp8266, 6-11 are wired to the flash
+GPIO_PINS = (0, 1, 2, 3, 4, 5, 12, 13, 14, 15, 16)
+UART_PINS = {1: "tx", 3: "rx", 15: "tx", 13: "rx"}
+
+# Telnet
+IAC = 0xff
+SB = 0xfa
+SE = 0xf0
+WILL = 0xfb
+WONT = 0xfc
+DO = 0xfd
+DONT = 0xfe
+
+def strip_iac(data: bytes):
+    # drop telnet commands and unescape IAC IAC, the emulated device never negotiates
+    if IAC not in data:
+        return data
+    output = bytearray()
+    i = 0
+    while i < len(data):
+        byte = data[i]
+        if byte != IAC:
+            output.append(byte)
+            i += 1
+        elif i + 1 < len(data) and data[i + 1] == IAC:
+            output.append(IAC)
+            i += 2
+        elif i + 1 < len(data) and data[i + 1] in (WILL, WONT, DO, DONT):
+            i += 3
+        elif i + 1 < len(data) and data[i + 1] == SB:
+            end = data.find(bytes((IAC, SE)), i + 2)
+            i = len(data) if end < 0 else end + 2
+        else:
+            i += 2
+    return bytes(output)
+
+def escape_iac(data: bytes):
+    return data.replace(bytes((IAC,)), bytes((IAC, IAC)))
+
+class Esp8266Emulator(object):
+    def __init__(self, config: dict = None, uart_config: dict = None, loop=None):
+        self.loop = loop if loop is not None else asyncio.get_event_loop()
+        self.config = dict(EMULATOR_CONFIG)
+        if config is not None:
+            self.config.update(config)
+        self.uart_config = dict(UART_EMULATOR_CONFIG)
+        if uart_config is not None:
+            self.uart_config.update(uart_config)
+
+        self.random = random.Random(self.config['seed'])
+        self.pins: dict = {pin: {"mode": "uart" if pin in (1, 3) else "input", "flags": "", "level": 0}
+                           for pin in GPIO_PINS}
+        self.flags: dict = {"log-to-uart": False}
+        self.bridge_port = self.config['bridge_port']
+        self.is_power_pressed = False
+
+        self.servers = []
+        self.bridge_writers = set()
+        self.console_task = None
+
+    # Pins
+    def get_pin_info(self, pin):
+        state = self.pins[pin]
+        if state["mode"] == "uart":
+            info = "pin:  {}, mode: uart     [hw: uart     ] flags: [{}], uart, max value: 255, info: uart 0, pin: {}".format(
+                pin, state["flags"], UART_PINS.get(pin, "rx"))
+            if UART_PINS.get(pin) == "tx":
+                info += ", autofill: no, character: 0x00"
+            return info
+        return "pin:  {0}, mode: digital {1} [hw: digital {1}] flags: [{2}], state: {3}, max value: 1, info:".format(
+            pin, state["mode"], state["flags"], "on" if state["level"] else "off")
+
+    def press_power(self, level):
+        if level == self.config['power_active_level']:
+            self.is_power_pressed = True
+        elif self.is_power_pressed:
+            self.is_power_pressed = False
+            status = self.pins[self.config['status_pin']]
+            status["level"] = 1 - status["level"]
+
+    def handle_io_mode(self, args):
+        # im [0 <pin> [dinput|doutput|uart]]
+        if len(args) < 3:
+            return [self.get_pin_info(pin) for pin in GPIO_PINS]
+        pin = int(args[2])
+        if len(args) > 3:
+            mode = {"dinput": "input", "doutput": "output", "uart": "uart"}.get(args[3])
+            if mode is None or (mode == "uart" and pin not in UART_PINS):
+                return "> invalid mode"
+            self.pins[pin]["mode"] = mode
+        return self.get_pin_info(pin)
+
+    def handle_io_flag(self, args):
+        # isf|icf 0 <pin> autostart
+        pin = int(args[2])
+        self.pins[pin]["flags"] = args[3] if args[0] == "isf" else ""
+        return "flags for pin 0/{}:{}".format(pin, self.pins[pin]["flags"])
+
+    def handle_io_write(self, args):
+        # iw 0 <pin> <level>
+        pin = int(args[2])
+        state = self.pins[pin]
+        if state["mode"] != "output":
+            return "digital {}: cannot write to gpio {}".format(state["mode"], args[3])
+        state["level"] = 1 if int(args[3]) else 0
+        if pin == self.config['power_pin']:
+            self.press_power(state["level"])
+        return "digital output: [{}]".format(state["level"])
+
+    def handle_io_read(self, args):
+        # ir 0 <pin>
+        state = self.pins[int(args[2])]
+        if state["mode"] == "uart":
+            return "> invalid mode"
+        return "digital {}: [{}]".format(state["mode"], state["level"])
+
+    # Uart
+    def handle_bridge_port(self, args):
+        # bp [<port>], stored only, the bridge keeps listening where it was started
+        if len(args) > 1:
+            self.bridge_port = int(args[1])
+        return "> port: {}".format(self.bridge_port)
+
+    def handle_uart(self, args):
+        # ub|ud|us|up 0 [<value>]
+        key, label = {"ub": ("baud_rate", "baudrate"), "ud": ("data_bits", "data bits"),
+                      "us": ("stop_bits", "stop bits"), "up": ("parity", "parity")}[args[0]]
+        if len(args) > 2:
+            value = args[2] if key == "parity" else int(args[2])
+            if value == self.uart_config[key] and key == "stop_bits":
+                # stop bits already in effect, the firmware has no config entry to replace
+                return "> cannot delete config (default values)"
+            self.uart_config[key] = value
+        return "> {}[0]: {}".format(label, self.uart_config[key])
+
+    def handle_flag_unset(self, args):
+        # fu [<flag>]
+        if len(args) > 1:
+            if args[1] not in self.flags:
+                return "> unknown flag"
+            self.flags[args[1]] = False
+        return "> {}".format(" ".join(("" if value else "no ") + flag for flag, value in self.flags.items()))
+
+    def handle_command(self, line):
+        args = line.split()
+        if not args:
+            return "> empty command"
+        handler = {
+            "im": self.handle_io_mode,
+            "isf": self.handle_io_flag,
+            "icf": self.handle_io_flag,
+            "iw": self.handle_io_write,
+            "ir": self.handle_io_read,
+            "bp": self.handle_bridge_port,
+            "ub": self.handle_uart,
+            "ud": self.handle_uart,
+            "us": self.handle_uart,
+            "up": self.handle_uart,
+            "fu": self.handle_flag_unset
+        }.get(args[0])
+        if handler is None:
+            return "{}: command unknown".format(args[0])
+        try:
+            return handler(args)
+        except (IndexError, ValueError, KeyError):
+            return "> invalid argument"
+
+    async def handle_command_client(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+
+                # fault injection
+                delay = self.config['latency'] + self.random.uniform(0, self.config['jitter'])
+                if delay > 0:
+                    await asyncio.sleep(delay, loop=self.loop)
+                if self.random.random() < self.config['disconnect_rate']:
+                    logging.debug("emulating disconnect")
+                    break
+
+                response = self.handle_command(strip_iac(line).decode('utf8', 'replace').strip())
+                if self.random.random() < self.config['drop_rate']:
+                    logging.debug("emulating dropped response")
+                    continue
+                lines = response if isinstance(response, list) else [response]
+                writer.write("".join("{}\r\n".format(response_line) for response_line in lines).encode('utf8'))
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    def get_char_time(self):
+        # seconds on the wire per character, start bit + data + parity + stop
+        bits = 1 + self.uart_config['data_bits'] + (0 if self.uart_config['parity'] == "none" else 1) + self.uart_config['stop_bits']
+        return bits / self.uart_config['baud_rate']
+
+    async def write_bridge(self, data: bytes):
+        # output leaves the uart no faster than the baud rate
+        for writer in list(self.bridge_writers):
+            try:
+                writer.write(escape_iac(data))
+            except Exception:
+                self.bridge_writers.discard(writer)
+        await asyncio.sleep(len(data) * self.get_char_time(), loop=self.loop)
+
+    async def handle_bridge_client(self, reader, writer):
+        self.bridge_writers.add(writer)
+        try:
+            while True:
+                data = await reader.read(1024)
+                if not data:
+                    break
+                # the attached console echoes its input
+                await self.write_bridge(strip_iac(data))
+        except ConnectionError:
+            pass
+        finally:
+            self.bridge_writers.discard(writer)
+            writer.close()
+
+    async def generate_console(self):
+        count = 0
+        while True:
+            if self.bridge_writers:
+                count += 1
+                line = "[{:10d}] emulated console output line at {} baud\r\n".format(count, self.uart_config['baud_rate']).encode('utf8')
+                await self.write_bridge(line)
+                await asyncio.sleep(max(0, len(line) / self.config['console_rate'] - len(line) * self.get_char_time()), loop=self.loop)
+            else:
+                await asyncio.sleep(0.1, loop=self.loop)
+
+    async def start(self):
+        self.servers.append(await asyncio.start_server(self.handle_command_client, self.config['host'], self.config['command_port'], loop=self.loop))
+        self.servers.append(await asyncio.start_server(self.handle_bridge_client, self.config['host'], self.config['bridge_port'], loop=self.loop))
+        if self.config['console_rate'] > 0:
+            self.console_task = asyncio.ensure_future(self.generate_console(), loop=self.loop)
+        logging.info("emulating esp8266 on %s, command port %s, bridge port %s",
+                     self.config['host'], self.config['command_port'], self.config['bridge_port'])
+
+    async def stop(self):
+        if self.console_task is not None:
+            self.console_task.cancel()
+        for server in self.servers:
+            server.close()
+            await server.wait_closed()
+        self.servers = []
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog='esp8266emulator',
+        description='Universal IO Bridge ESP8266 emulator',
+        conflict_handler='resolve'
+    )
+    parser.add_argument('--host',
+                        dest='host',
+                        default=EMULATOR_CONFIG['host'],
+                        help='Address to listen on; defaults to 127.0.0.1')
+    parser.add_argument('--command-port',
+                        dest='command_port',
+                        type=int,
+                        default=EMULATOR_CONFIG['command_port'],
+                        help='First command port; defaults to 24')
+    parser.add_argument('--bridge-port',
+                        dest='bridge_port',
+                        type=int,
+                        default=EMULATOR_CONFIG['bridge_port'],
+                        help='First uart bridge port; defaults to 23')
+    parser.add_argument('--count',
+                        dest='count',
+                        type=int,
+                        default=1,
+                        help='Devices to emulate, each on the next pair of ports; defaults to 1')
+    parser.add_argument('--latency',
+                        dest='latency',
+                        type=float,
+                        default=EMULATOR_CONFIG['latency'],
+                        help='Seconds before each command response; defaults to 0')
+    parser.add_argument('--jitter',
+                        dest='jitter',
+                        type=float,
+                        default=EMULATOR_CONFIG['jitter'],
+                        help='Random extra seconds before each command response; defaults to 0')
+    parser.add_argument('--drop-rate',
+                        dest='drop_rate',
+                        type=float,
+                        default=EMULATOR_CONFIG['drop_rate'],
+                        help='Probability a command response is dropped; defaults to 0')
+    parser.add_argument('--disconnect-rate',
+                        dest='disconnect_rate',
+                        type=float,
+                        default=EMULATOR_CONFIG['disconnect_rate'],
+                        help='Probability a command disconnects the client; defaults to 0')
+    parser.add_argument('--console-rate',
+                        dest='console_rate',
+                        type=float,
+                        default=EMULATOR_CONFIG['console_rate'],
+                        help='Generated console output on the uart bridge in bytes/s; defaults to 0')
+    parser.add_argument('--baud-rate',
+                        dest='baud_rate',
+                        type=int,
+                        default=UART_EMULATOR_CONFIG['baud_rate'],
+                        help='Uart baud rate; defaults to 115200')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(relativeCreated)6d %(threadName)s %(levelname)s:%(message)s')
+
+    loop = asyncio.get_event_loop()
+    for index in range(args.count):
+        # i.e. 24/23, 26/25, ...
+        emulator = Esp8266Emulator({
+            "host": args.host,
+            "command_port": args.command_port + 2 * index,
+            "bridge_port": args.bridge_port + 2 * index,
+            "latency": args.latency,
+            "jitter": args.jitter,
+            "drop_rate": args.drop_rate,
+            "disconnect_rate": args.disconnect_rate,
+            "console_rate": args.console_rate
+        }, {"baud_rate": args.baud_rate}, loop=loop)
+        loop.run_until_complete(emulator.start())
+    loop.run_forever()
+
+if __name__ == '__main__':
+    sys.exit(main())
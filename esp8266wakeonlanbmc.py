@@ -3,18 +3,69 @@ import logging
 import argparse
 import sys
 import asyncio
+import threading
 import asyncbmc
 import esp8266bmc
+import telnetbmc
 from enum import IntEnum
 from itertools import chain
-from wakeonlan import send_magic_packet
+from wakeonlan import create_magic_packet
 
 WOL_CONFIG = {
     "mac": 'AA:BB:CC:DD:EE:FF',
     "port": 9,
-    "ip": '255.255.255.255'
+    "ip": '255.255.255.255',
+    # magic packets are unacknowledged udp, repeat them
+    "burst": 3,
+    "burst_interval": 0.1,
+    # command session connect while the target boots
+    "connection_retries": 5,
+    "connection_timeout": 3
 }
 
+class AsyncWakeOnLanSender(asyncbmc.AsyncThreadedObject):
+    # one broadcast datagram socket per loop, shared by all targets
+    senders = {}
+    senders_lock = threading.Lock()
+
+    @classmethod
+    def get_sender(cls, loop=None):
+        if loop is None:
+            loop = asyncbmc.AsyncRuntime.get_runtime().loop
+        with cls.senders_lock:
+            if loop not in cls.senders:
+                cls.senders[loop] = cls(name="wakeonlan", loop=loop)
+            return cls.senders[loop]
+
+    def __init__(self, name=None, loop=None):
+        asyncbmc.AsyncThreadedObject.__init__(self, name=name, loop=loop)
+        self.transport = None
+        self.open_lock = asyncio.Lock(loop=self.loop)
+
+    async def open(self):
+        async with self.open_lock:
+            if self.transport is None or self.transport.is_closing():
+                self.transport, _ = await self.loop.create_datagram_endpoint(asyncio.DatagramProtocol, 
+                                                                             local_addr=('0.0.0.0', 0), 
+                                                                             allow_broadcast=True)
+        return self.transport
+
+    def close(self):
+        if self.transport is not None:
+            self.transport.close()
+            self.transport = None
+
+    async def wake(self, *macs, ip='255.255.255.255', port=9, burst=1, burst_interval=0):
+        packets = [create_magic_packet(mac) for mac in macs]
+        transport = await self.open()
+        for repeat in range(burst):
+            if repeat:
+                await asyncio.sleep(burst_interval, loop=self.loop)
+            for packet in packets:
+                transport.sendto(packet, (ip, port))
+        logging.debug("WakeOnLan: sent %s x %s packets to %s:%s", burst, len(packets), ip, port)
+        return len(packets)
+
 class Esp8266WakeOnLanBmc(esp8266bmc.Esp8266Bmc):
     def __init__(self, authdata, button_config, gpio_config: dict, command_telnet_config: dict, sol_telnet_config: dict, uart_config: dict, wol_config: dict, name=None, port=623, loop=None):
         esp8266bmc.Esp8266Bmc.__init__(self, authdata, button_config, gpio_config, command_telnet_config, sol_telnet_config, uart_config, name=name, port=port, loop=loop)
@@ -28,43 +79,31 @@ class Esp8266WakeOnLanBmc(esp8266bmc.Esp8266Bmc):
         self.wol_mac = self.wol_config['mac']
         self.wol_port = self.wol_config['port']
         self.wol_ip = self.wol_config['ip']
+        self.wol_burst = self.wol_config['burst']
+        self.wol_burst_interval = self.wol_config['burst_interval']
+        self.wol_connection_retries = self.wol_config['connection_retries']
+        self.wol_connection_timeout = self.wol_config['connection_timeout']
 
     async def press_power_on(self, press_duration):
         #powerstate = await self.async_get_power_state()
         #if (powerstate == 0 ):
         #press_duration = 3
-        send_magic_packet(self.wol_mac,
-                          ip_address=self.wol_ip,
-                          port=self.wol_port)
-        logging.debug('''WakeOnLan: 
-                        mac: {}
-                         ip: {}
-                       port: {}'''
-                       .format(self.wol_mac, 
-                               self.wol_ip, 
-                               self.wol_port))
-
-        # up retries
-        connection_retries = self.command_telnet_session.connection_retries
-        self.command_telnet_session.connection_retries = 5
-
-        connection_timeout = self.command_telnet_session.connection_timeout
-        self.command_telnet_session.connection_timeout = 3
         try:
+            await AsyncWakeOnLanSender.get_sender(self.loop).wake(self.wol_mac, ip=self.wol_ip, port=self.wol_port, 
+                                                                  burst=self.wol_burst, burst_interval=self.wol_burst_interval)
             await asyncio.sleep(press_duration, loop=self.loop)
-            # reset waiters
-            # self._waiter_connected = None
-            # self._waiter_closed = None
+            if not telnetbmc.TelnetSessionPool.get_pool().is_shared(self.command_telnet_session):
+                # the target was expected to be unreachable until now, other bmcs on the device still rely on the breaker
+                self.command_telnet_session.breaker.reset()
 
-            # connect session
-            await self.command_telnet_session.connect()
+            # connect session, with more patience while the target boots
+            await self.command_telnet_session.connect(connection_retries=self.wol_connection_retries, 
+                                                      connection_timeout=self.wol_connection_timeout)
             
         except Exception as e:
             logging.error(e)
-        # reset retries
-        self.command_telnet_session.connection_retries = connection_retries
-        self.command_telnet_session.connection_timeout = connection_timeout
 
+        self.invalidate_power_state()
         powerstate = await self.async_get_power_state()
         #else:
         #    logging.info('already powered on')
@@ -77,17 +116,22 @@ class Esp8266WakeOnLanBmc(esp8266bmc.Esp8266Bmc):
             try:
                 await self.power_button.press(press_duration)
 
-                # remove session
-                await self.command_telnet_session.disconnect()
+                # remove session, unless other bmcs on the device are still using it
+                await telnetbmc.TelnetSessionPool.get_pool().close_unshared(self.command_telnet_session)
 
             except Exception as e:
                 logging.error(e)
 
+            self.invalidate_power_state()
             powerstate = await self.async_get_power_state()
         else:
             logging.info('already powered off')
         return powerstate
        
+    def is_available(self):
+        # unreachable means powered off, still answered and woken over the network
+        return True
+
     async def setup_power_status(self):
         # create power status input pin
         self.power_status =  asyncbmc.AsyncSerialSessionConnectionStatus(self.command_telnet_session, name="power_status", loop=self.loop)
@@ -108,7 +152,20 @@ def main():
                         type=int,
                         default=623,
                         help='Port to listen on; defaults to 623')
+    parser.add_argument('--wake',
+                        dest='wake',
+                        nargs='+',
+                        default=None,
+                        help='Send WakeOnLan to the given MAC addresses and exit')
     args = parser.parse_args()
+
+    if args.wake:
+        sender = AsyncWakeOnLanSender.get_sender()
+        sender.run_coroutine_threadsafe(
+            sender.wake(*args.wake, ip=WOL_CONFIG['ip'], port=WOL_CONFIG['port'], 
+                        burst=WOL_CONFIG['burst'], burst_interval=WOL_CONFIG['burst_interval'])).result()
+        return 0
+
     mybmc = Esp8266WakeOnLanBmc({}, {}, {}, {}, {}, {}, {}, port=args.port)
     mybmc.listen()
 
@@ -6,14 +6,20 @@ import RPi.GPIO as GPIO
 import time
 from pinbmc import PinBmc, DigitalPin
 
+# fakeRPiGPIO has no BOTH
+GPIO_BOTH = getattr(GPIO, 'BOTH', 'BOTH')
+
+PI_GPIO_CONFIG = {
+    "bouncetime": 50
+}
 
 class PiPin(DigitalPin):
     async def setup(self):
         if self.is_valid_pin(self.pin):
-            if self.is_output:  # input
+            if self.is_output:  # output
+                GPIO.setup(self.pin, GPIO.OUT, initial=self.logic_level)
+            else:  # input
                 GPIO.setup(self.pin, GPIO.IN)
-            else:  # output
-                GPIO.setup(self.pin, GPIO.OUT, self.logic_level)
 
     def get_true_logic_level(self):
         return GPIO.HIGH
@@ -24,13 +30,29 @@ class PiPin(DigitalPin):
     async def write_logic_level(self):
         if self.pin is not None:
             GPIO.output(self.pin, self.logic_level)
+            return
         raise ValueError("pin is None!")
 
-    async def read_logic_level(self, logic_level):
+    async def read_logic_level(self):
         if self.pin is not None:
             self.logic_level = GPIO.input(self.pin)
+            return self.logic_level
         raise ValueError("pin is None!")
 
+    async def start_edge_detection(self, scheduler=None):
+        if self.is_valid_pin(self.pin) and not self.is_output:
+            GPIO.add_event_detect(self.pin, GPIO_BOTH, callback=self.on_gpio_edge, bouncetime=PI_GPIO_CONFIG['bouncetime'])
+            return True
+        return False
+
+    async def stop_edge_detection(self):
+        if self.is_valid_pin(self.pin) and not self.is_output:
+            GPIO.remove_event_detect(self.pin)
+
+    def on_gpio_edge(self, channel):
+        # called from the RPi.GPIO event thread
+        self.loop.call_soon_threadsafe(self.on_edge, GPIO.input(channel))
+
 class PiBmc(PinBmc):
    
     def __del__(self):
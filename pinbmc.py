@@ -1,8 +1,10 @@
 #!/usr/bin/env python
 
+import logging
 import argparse
 import sys
 import asyncio
+import asyncbmc
 import buttonbmc
 
 GPIO_CONFIG = {
@@ -15,6 +17,8 @@ GPIO_CONFIG = {
 }
 
 class DigitalPin(buttonbmc.Button):
+    # seconds between reads of an input pin watched for edges, None without a cheap read
+    WATCH_INTERVAL = None
 
     def __init__(self, pin: int, is_output: bool = True, value: bool = False, invert_logic: bool = False, loop=None):
         buttonbmc.Button.__init__(self, value, loop=loop)
@@ -24,6 +28,9 @@ class DigitalPin(buttonbmc.Button):
         self.invert_logic: bool = invert_logic
         self.value: bool = value
         self.logic_level = self.value_to_logic_level(value)
+        self.single_flight = asyncbmc.AsyncSingleFlight(loop=self.loop)
+        self.watch_task = None
+        self.read_time = None
 
     async def setup(self):
         # raise NotImplementedError
@@ -56,6 +63,8 @@ class DigitalPin(buttonbmc.Button):
 
     async def set_value(self, value: bool):
         if self.pin is not None:
+            # reads started before this write must not be shared with later readers
+            self.single_flight.forget()
             self.logic_level = self.value_to_logic_level(value)
             # attempt to write logic level
             await self.write_logic_level()
@@ -65,11 +74,66 @@ class DigitalPin(buttonbmc.Button):
 
     async def get_value(self):
         if self.pin is not None:
-            await self.read_logic_level()
-            self.value = self.logic_level_to_value(self.logic_level)
-            return self.value 
+            # concurrent readers of this pin share one hardware read
+            return await self.single_flight.do('get_value', self._get_value)
         raise ValueError("pin is None!")
 
+    async def _get_value(self):
+        await self.read_logic_level()
+        return self.on_edge(self.logic_level)
+
+    def invalidate(self):
+        self.single_flight.forget()
+
+    def get_read_age(self):
+        return None if self.read_time is None else self.loop.time() - self.read_time
+
+    def on_edge(self, logic_level):
+        # any read or detected edge that changes the value is pushed to subscribers
+        self.logic_level = logic_level
+        self.read_time = self.loop.time()
+        value = self.logic_level_to_value(logic_level)
+        is_changed = value != self.value
+        self.value = value
+        if is_changed:
+            self.notify(self.value)
+        return self.value
+
+    async def start_edge_detection(self, scheduler: asyncbmc.AsyncScheduler = None):
+        # without hardware edge detection, watch input pins that are cheap to read
+        if self.WATCH_INTERVAL and not self.is_output and self.pin is not None:
+            if not self.is_watching():
+                self.watch_task = asyncio.ensure_future(self._watch(scheduler), loop=self.loop)
+            return True
+        return False
+
+    async def stop_edge_detection(self):
+        if self.is_watching():
+            self.watch_task.cancel()
+        self.watch_task = None
+
+    def is_watching(self):
+        return self.watch_task is not None and not self.watch_task.done()
+
+    async def _watch(self, scheduler: asyncbmc.AsyncScheduler = None):
+        asyncbmc.RetryBudget.set_current(None)
+        while True:
+            # any read of the pin counts, the watcher only fills the gaps between them
+            age = None if self.read_time is None else self.loop.time() - self.read_time
+            if age is None or age >= self.WATCH_INTERVAL:
+                try:
+                    if scheduler is not None:
+                        # behind everything else queued for the target
+                        await scheduler.submit(asyncbmc.AsyncScheduler.Priority.BACKGROUND, self.get_value, key=(id(self), 'watch'))
+                    else:
+                        await self.get_value()
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    logging.error(e)
+                age = 0
+            await asyncio.sleep(self.WATCH_INTERVAL - age, loop=self.loop)
+
     def is_valid_pin(self, s):
         # raise NotImplementedError
         try:
@@ -4,7 +4,14 @@ import asyncio
 import argparse
 import pyghmi.ipmi.bmc as bmc
 import pyghmi.cmd.fakebmc as fakebmc
+import pyghmi.ipmi.private.session as ipmisession
 import sys
+import os
+import signal
+import socket
+import json
+import time
+from collections import OrderedDict
 import asyncbmc
 from esp8266bmc import Esp8266Bmc
 from esp8266wakeonlanbmc import Esp8266WakeOnLanBmc
@@ -13,18 +20,218 @@ from esp8266wakeonlanbmc import Esp8266WakeOnLanBmc
 https://www.intel.com/content/dam/www/public/us/en/documents/specification-updates/ipmi-intelligent-platform-mgt-interface-spec-2nd-gen-v2-0-spec-update.pdf
 '''
 
+# Supervisor mode, workers share the ipmi port with SO_REUSEPORT and each owns the targets with addr % workers == index
+SHARD_CONFIG = {
+    "workers": 1,
+    "forward_timeout": 5,
+    "max_sessions": 1024,
+    "restart_backoff": 1
+}
+
+# Targets whose setup failed are retried, the backoff doubles per failure up to max_retry_backoff
+SETUP_CONFIG = {
+    "retry_backoff": 5,
+    "max_retry_backoff": 300
+}
+
+def create_shard_links(count: int):
+    # a connected unix datagram pair per two workers, made before they start so no other process can reach a link
+    links = [dict() for _ in range(count)]
+    for index in range(count):
+        for peer in range(index + 1, count):
+            links[index][peer], links[peer][index] = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+    return links
+
+class PyPmbForwardedSession(object):
+    # stands in for the ServerSession of a client served by another worker, responses go back over the link
+    def __init__(self, link, peer: int, sid: int):
+        self.link = link
+        self.peer = peer
+        self.sid = sid
+        # qualified by worker, the proxy cache keys on it to answer retransmits
+        self.localsid = (peer, sid)
+        self.seqlun = None
+        self.clientaddr = None
+        self.clientnetfn = None
+        self.clientcommand = None
+        self.sequencenumber = None
+        self.timeout = link.config['forward_timeout']
+
+    def update(self, message):
+        self.seqlun = message['seqlun']
+        self.clientnetfn = message['netfn'] + 1
+        self.clientcommand = message['command']
+
+    def send_ipmi_response(self, data=[], code=0):
+        self._send_ipmi_net_payload(data=data, code=code)
+
+    def _send_ipmi_net_payload(self, netfn=None, command=None, data=(), code=0,
+                               bridge_request=None,
+                               retry=None, delay_xmit=None, timeout=None):
+        # seqlun is restored by the proxy answering, it matches the response to its request like ipmi does
+        self.link.send(self.peer, {'sid': self.sid, 'seqlun': self.seqlun, 'code': code, 'data': list(data)})
+
+class PyPmbShardLink(asyncbmc.AsyncThreadedObject):
+    # bridge requests for a target owned by another worker are forwarded to it over the inherited socketpairs
+    def __init__(self, mypmb, index: int, count: int, sockets, config=None, name=None, loop=None):
+        asyncbmc.AsyncThreadedObject.__init__(self, name=name, loop=loop)
+        self.pmb = mypmb
+        self.index = index
+        self.count = count
+        # peer -> socket, the pairs are connected so a socket identifies its peer
+        self.sockets = sockets
+        self.is_open = False
+        self.config = dict(SHARD_CONFIG)
+        if config is not None:
+            self.config.update(config)
+        # (sid, seqlun) -> (proxy, timeout handle), forwarded requests waiting on their owner
+        self.pending = dict()
+        # (peer, sid) -> PyPmbForwardedSession, clients of other workers served here
+        self.sessions = OrderedDict()
+
+    def get_owner(self, addr: int):
+        return addr % self.count
+
+    def is_owner(self, addr: int):
+        return self.get_owner(addr) == self.index
+
+    async def open(self):
+        # asyncio's datagram transport can't send on a socketpair (no peername), read and write the sockets directly
+        if not self.is_open:
+            for peer, sock in self.sockets.items():
+                sock.setblocking(False)
+                self.loop.add_reader(sock, self.on_readable, peer)
+            self.is_open = True
+
+    def close(self):
+        if self.is_open:
+            for sock in self.sockets.values():
+                self.loop.remove_reader(sock)
+            self.is_open = False
+        for proxy, handle in self.pending.values():
+            handle.cancel()
+        self.pending.clear()
+
+    def send(self, peer: int, message):
+        sock = self.sockets.get(peer)
+        if sock is not None:
+            try:
+                sock.send(json.dumps(message).encode('utf8'))
+            except OSError as e:
+                # peer is backed up or restarting, the request times out and the client retransmits
+                logging.warning("link to worker %s: %s", peer, e)
+
+    def on_readable(self, peer: int):
+        while True:
+            try:
+                data = self.sockets[peer].recv(65536)
+            except BlockingIOError:
+                return
+            except OSError as e:
+                logging.warning("link to worker %s: %s", peer, e)
+                return
+            self.on_message(peer, data)
+
+    def forward(self, addr: int, request, session):
+        # snapshot the request header now, the session takes new requests before the owner answers
+        proxy = asyncbmc.AsyncSessionProxy(session, loop=self.loop)
+        message = {'sid': session.localsid, 'seqlun': proxy.seqlun, 'addr': addr,
+                   'netfn': request['netfn'], 'command': request['command'], 'data': list(request['data'])}
+        self.pmb.dispatch(self.async_forward(message, proxy))
+
+    async def async_forward(self, message, proxy: asyncbmc.AsyncSessionProxy):
+        key = (message['sid'], message['seqlun'])
+        # a retransmit replaces the request it repeats
+        _, handle = self.pending.pop(key, (None, None))
+        if handle is not None:
+            handle.cancel()
+        handle = self.loop.call_later(self.config['forward_timeout'], self.on_forward_timeout, key)
+        self.pending[key] = (proxy, handle)
+        self.send(self.get_owner(message['addr']), message)
+        asyncbmc.Metrics.get_metrics().inc('pypmb_forwarded_requests_total', {'worker': self.index})
+
+    def on_forward_timeout(self, key):
+        proxy, _ = self.pending.pop(key, (None, None))
+        if proxy is not None:
+            logging.warning("forwarded request on session %s timed out", key[0])
+            # Timeout while processing command
+            proxy.send_ipmi_response(code=0xc3)
+
+    def get_session(self, peer: int, message):
+        key = (peer, message['sid'])
+        session = self.sessions.get(key)
+        if session is None:
+            session = self.sessions[key] = PyPmbForwardedSession(self, peer, message['sid'])
+            while len(self.sessions) > self.config['max_sessions']:
+                self.sessions.popitem(last=False)
+        self.sessions.move_to_end(key)
+        session.update(message)
+        return session
+
+    def on_message(self, peer: int, data):
+        try:
+            message = json.loads(data.decode('utf8'))
+            if 'code' in message:
+                proxy, handle = self.pending.pop((message['sid'], message['seqlun']), (None, None))
+                if proxy is not None:
+                    handle.cancel()
+                    proxy.send_ipmi_response(data=message['data'], code=message['code'])
+            else:
+                request = {'netfn': message['netfn'], 'command': message['command'], 'data': bytearray(message['data'])}
+                self.pmb.handle_forwarded_request(message['addr'], request, self.get_session(peer, message))
+        except Exception as e:
+            logging.error(e)
+
 class PyPmb(asyncbmc.AsyncBmc):
-    def __init__(self, authdata, name=None, port=623, loop=None):
+    def __init__(self, authdata, name=None, port=623, loop=None, max_concurrent_setups: int=16):
         self.additionaldevices = 0
         self.targetbmcs = dict()
+        # addrs of targets done with setup, the bridge serves these while the rest finish
+        self.readytargets = set()
+        self.max_concurrent_setups = max_concurrent_setups
+        self.setup_config = dict(SETUP_CONFIG)
+        # set in supervisor mode, targets owned by other workers are reached through it
+        self.shard_link: PyPmbShardLink = None
 
         asyncbmc.AsyncBmc.__init__(self, authdata, name=name, port=port, loop=loop)
 
+    def share_port(self, port: int, address='::'):
+        # SO_REUSEPORT must be set before bind and pyghmi binds in IpmiServer, swap our own socket in
+        addrinfo = socket.getaddrinfo(address, port, 0, socket.SOCK_DGRAM)[0]
+        serversocket = socket.socket(addrinfo[0], socket.SOCK_DGRAM)
+        if addrinfo[0] == socket.AF_INET6:
+            serversocket.setsockopt(ipmisession.IPPROTO_IPV6, socket.IPV6_V6ONLY, 0)
+        serversocket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        serversocket.bind(addrinfo[4])
+
+        oldsocket = self.serversocket
+        ipmisession.iosockets.append(serversocket)
+        ipmisession.Session.bmc_handlers[serversocket] = {0: self}
+        ipmisession.Session.bmc_handlers.pop(oldsocket, None)
+        if oldsocket in ipmisession.iosockets:
+            ipmisession.iosockets.remove(oldsocket)
+        oldsocket.close()
+        self.serversocket = serversocket
+        self.port = port
+
+    def set_shard(self, index: int, count: int, sockets, config=None):
+        self.shard_link = PyPmbShardLink(self, index, count, sockets, config=config, name=self.name, loop=self.loop)
+        self.run_coroutine_threadsafe(self.shard_link.open()).result()
+
+    def is_owner(self, addr: int):
+        return self.shard_link is None or self.shard_link.is_owner(addr)
+
     def add_target(self, addr: int, newbmc: bmc.Bmc):
         if (addr >= 0 and addr <= 255): # and self.targetbmcs[addr] is None):
-            if (newbmc is not None):
+            if not self.is_owner(addr):
+                # another worker sets up and serves it
+                logging.debug("target %s is owned by worker %s", addr, self.shard_link.get_owner(addr))
+            elif (newbmc is not None):
                 self.targetbmcs[addr] = newbmc
                 self.additionaldevices += 1
+                if not isinstance(newbmc, asyncbmc.AsyncBmc):
+                    # nothing to setup
+                    self.readytargets.add(addr)
             else:
                 raise ValueError("invalid bmc '{0}' given".format(addr))
         else:
@@ -33,17 +240,67 @@ class PyPmb(asyncbmc.AsyncBmc):
     def remove_target(self, addr: int):
         if (addr >= 0 and addr <= 255):
             # bmcs[channel] = None
-            self.targetbmcs.pop(addr)
+            oldbmc = self.targetbmcs.pop(addr)
+            self.readytargets.discard(addr)
+            if isinstance(oldbmc, asyncbmc.AsyncBmc):
+                oldbmc.dispatch(oldbmc.teardown())
             if self.additionaldevices > 0:
                 self.additionaldevices -= 1
         else:
             raise ValueError("invalid target addr '{0}' given".format(addr))
 
+    async def setup_target(self, addr: int, mybmc: asyncbmc.AsyncBmc):
+        # validation and setup queue behind any power action already submitted to the target
+        setup = mybmc.scheduler.submit(asyncbmc.AsyncScheduler.Priority.MAINTENANCE, mybmc.setup)
+        if mybmc.loop is self.loop:
+            await setup
+        else:
+            # target opted in to its own threaded loop
+            await asyncio.wrap_future(mybmc.run_coroutine_threadsafe(setup), loop=self.loop)
+        self.readytargets.add(addr)
+
     async def setup(self):
-        # setup bmcs
-        for mybmc in self.targetbmcs.values():
-            if isinstance(mybmc, asyncbmc.AsyncBmc):
-                asyncbmc.wait_for_sync(mybmc.setup(), loop=mybmc.loop)
+        # setup bmcs concurrently, at most max_concurrent_setups at a time
+        semaphore = asyncio.Semaphore(self.max_concurrent_setups, loop=self.loop)
+        targets = [(addr, mybmc) for addr, mybmc in self.targetbmcs.items() if isinstance(mybmc, asyncbmc.AsyncBmc)]
+        total = len(targets)
+        progress = {'done': 0, 'failed': 0}
+
+        async def limited_setup_target(addr, mybmc):
+            async with semaphore:
+                is_ready = False
+                try:
+                    await self.setup_target(addr, mybmc)
+                    is_ready = True
+                except Exception as e:
+                    progress['failed'] += 1
+                    logging.error("target %s (%s) setup failed: %s", addr, mybmc.name, e)
+                    self.schedule_setup_retry(addr, mybmc, self.setup_config['retry_backoff'])
+                progress['done'] += 1
+                logging.info("target %s (%s) setup %s [%s/%s, %s failed]", addr, mybmc.name, "ready" if is_ready else "failed",
+                             progress['done'], total, progress['failed'])
+                return addr, is_ready
+
+        results = await asyncio.gather(*[limited_setup_target(addr, mybmc) for addr, mybmc in targets], loop=self.loop)
+        return dict(results)
+
+    def schedule_setup_retry(self, addr: int, mybmc: asyncbmc.AsyncBmc, backoff: float):
+        logging.info("retrying setup of target %s (%s) in %ss", addr, mybmc.name, backoff)
+        self.loop.call_later(backoff, self.retry_setup_target, addr, mybmc, backoff)
+
+    def retry_setup_target(self, addr: int, mybmc: asyncbmc.AsyncBmc, backoff: float):
+        self.dispatch(self.async_retry_setup_target(addr, mybmc, backoff))
+
+    async def async_retry_setup_target(self, addr: int, mybmc: asyncbmc.AsyncBmc, backoff: float):
+        if self.targetbmcs.get(addr) is not mybmc or addr in self.readytargets:
+            # removed or set up by a cold reset meanwhile
+            return
+        try:
+            await self.setup_target(addr, mybmc)
+            logging.info("target %s (%s) setup ready after retry", addr, mybmc.name)
+        except Exception as e:
+            logging.error("target %s (%s) setup retry failed: %s", addr, mybmc.name, e)
+            self.schedule_setup_retry(addr, mybmc, min(backoff * 2, self.setup_config['max_retry_backoff']))
 
     def send_bridge_request(self, request, session):
         channel = int(request['data'][0])
@@ -55,34 +312,31 @@ class PyPmb(asyncbmc.AsyncBmc):
         command = int(request['data'][6])
         data = bytearray(request['data'][7:-1])
 
-        logging.debug('''IPMI Bridge Request :
-                              localsid: {}
-                        sequencenumber: {}
-                               timeout: {}
-                                  addr: {} 
-                               channel: {}
-                                 netfn: {}
-                               command: {}
-                                  data: {}
-                        '''.format(
-                            session.localsid,
-                            session.sequencenumber,
-                            session.timeout,
-                            str(addr),
-                            str(channel),
-                            str(netfn), #str(request['netfn']),
-                            str(command), #str(request['command']),
-                            bytes(data).hex() #bytes(request['data']).hex()
-                            ))
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            logging.debug("ipmi bridge request sid=%s seq=%s addr=%s channel=%s netfn=%s cmd=%s data=%s",
+                          session.localsid, session.sequencenumber, addr, channel, netfn, command, bytes(data).hex())
 
         targetbmc = self.targetbmcs.get(addr)
 
+        if targetbmc is None and not self.is_owner(addr):
+            # Command Completed Normally, the owner answers the bridged request
+            session.send_ipmi_response(code=0x00)
+            session.clientnetfn = netfn + 1
+            session.clientcommand = command
+            self.shard_link.forward(addr, {'netfn': netfn, 'command': command, 'data': data}, session)
+            return
+
+        if targetbmc is not None and addr not in self.readytargets:
+            logging.warning("Target address {} is not ready".format(addr))
+            # Node Busy
+            return session.send_ipmi_response(code=0xc0)
+
         if targetbmc is not None:
             # Command Completed Normally
             session.send_ipmi_response(code=0x00)
 
-            # for _send_ipmi_net_payload
-            session.clientnetfn = netfn
+            # for _send_ipmi_net_payload, responses carry the request netfn + 1
+            session.clientnetfn = netfn + 1
             session.clientcommand = command
 
             targetrequest = {'netfn': netfn, 'command': command, 'data': data}
@@ -98,6 +352,18 @@ class PyPmb(asyncbmc.AsyncBmc):
         # Requested Sensor, data, or record not present
         return session.send_ipmi_response(code=0xcb)
 
+    def handle_forwarded_request(self, addr: int, request, session: PyPmbForwardedSession):
+        targetbmc = self.targetbmcs.get(addr)
+        if targetbmc is None:
+            logging.error("Target address not found {}".format(addr))
+            # Requested Sensor, data, or record not present
+            return session.send_ipmi_response(code=0xcb)
+        if addr not in self.readytargets:
+            # Node Busy
+            return session.send_ipmi_response(code=0xc0)
+        targetbmc.port = self.port
+        targetbmc.handle_raw_request(request, session)
+
     def handle_raw_request(self, request, session):
         try:
             if request['netfn'] == 6:
@@ -116,6 +382,88 @@ class PyPmb(asyncbmc.AsyncBmc):
             session._send_ipmi_net_payload(code=0xff)
             logging.error(e)
 
+def run(args, index: int = 0, count: int = 1, sockets=None):
+    # logging
+    level = logging.INFO # logging.DEBUG # 
+    logging.basicConfig(level=level, format='%(relativeCreated)6d %(process)d %(threadName)s %(levelname)s:%(message)s' if count > 1 else
+                                            '%(relativeCreated)6d %(threadName)s %(levelname)s:%(message)s')
+
+    # all bmcs share the process-wide asyncbmc runtime loop unless given a loop (or threaded=True)
+    if count > 1:
+        mypmb = PyPmb({"admin":"changeme"}, name="pmb-{}".format(index), port=None, max_concurrent_setups=args.setup_concurrency)
+        mypmb.share_port(args.port)
+        mypmb.set_shard(index, count, sockets)
+    else:
+        mypmb = PyPmb({"admin":"changeme"}, name="pmb", port=args.port, max_concurrent_setups=args.setup_concurrency)
+
+    loop = mypmb.loop
+
+    # add target BMCs, a worker keeps only the ones it owns
+    mypmb.add_target(1, fakebmc.FakeBmc(mypmb.authdata, port=None))
+    #mypmb.add_target(2, Esp8266Bmc(mypmb.authdata, {}, {}, {'host':'192.168.1.11'}, {'host':'192.168.1.11'}, {'baud_rate':'38400'}, name="cloud1", port=None, loop=loop))
+    #mypmb.add_target(3, Esp8266WakeOnLanBmc(mypmb.authdata, {}, {}, {'host':'192.168.11.12'}, {'host':'192.168.1.12'}, {'baud_rate':'38400'}, {'mac':'AA:BB:CC:DD:EE:FF', 'ip':'192.168.1.255'}, name="cloud1", port=None, loop=loop)) 
+    
+    # metrics, one port and file per worker
+    metrics = asyncbmc.Metrics.get_metrics()
+    if args.metrics_port is not None:
+        mypmb.dispatch(metrics.start_server(asyncbmc.METRICS_CONFIG['host'], args.metrics_port + index, loop=loop))
+    if args.metrics_file is not None:
+        metrics_file = args.metrics_file if count == 1 else "{}.{}".format(args.metrics_file, index)
+        mypmb.dispatch(metrics.dump_periodically(metrics_file, asyncbmc.METRICS_CONFIG['dump_interval'], loop=loop))
+
+    # setup in the background, targets are served as they become ready
+    mypmb.dispatch(mypmb.setup())
+
+    mypmb.listen()
+
+def start_worker(args, index: int, count: int, links):
+    pid = os.fork()
+    if pid == 0:
+        # worker, nothing async exists yet in the supervisor so the fork is clean
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        # keep only our ends of the links
+        for other, sockets in enumerate(links):
+            if other != index:
+                for sock in sockets.values():
+                    sock.close()
+        try:
+            run(args, index, count, links[index])
+        finally:
+            os._exit(1)
+    return pid
+
+def supervise(args, count: int):
+    # fork before any loop or thread exists, restart workers that die so their targets stay served
+    # the supervisor keeps every link end open, a restarted worker picks its ends up again
+    links = create_shard_links(count)
+    workers = {start_worker(args, index, count, links): index for index in range(count)}
+    is_stopping = False
+
+    def stop(signum, frame):
+        nonlocal is_stopping
+        is_stopping = True
+        for pid in workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    while workers:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        index = workers.pop(pid, None)
+        if index is None or is_stopping:
+            continue
+        logging.error("worker {} (pid {}) exited with status {}, restarting".format(index, pid, status))
+        time.sleep(SHARD_CONFIG['restart_backoff'])
+        workers[start_worker(args, index, count, links)] = index
+
 def main():
     parser = argparse.ArgumentParser(
         prog='pypmb',
@@ -127,24 +475,34 @@ def main():
                         type=int,
                         default=623,
                         help='Port to listen on; defaults to 623')
+    parser.add_argument('--setup-concurrency',
+                        dest='setup_concurrency',
+                        type=int,
+                        default=16,
+                        help='Targets to setup concurrently; defaults to 16')
+    parser.add_argument('--workers',
+                        dest='workers',
+                        type=int,
+                        default=SHARD_CONFIG['workers'],
+                        help='Worker processes sharing the port, each serving a partition of the targets; defaults to 1')
+    parser.add_argument('--metrics-port',
+                        dest='metrics_port',
+                        type=int,
+                        default=asyncbmc.METRICS_CONFIG['port'],
+                        help='Local port serving prometheus metrics; disabled by default')
+    parser.add_argument('--metrics-file',
+                        dest='metrics_file',
+                        default=asyncbmc.METRICS_CONFIG['path'],
+                        help='File to periodically dump prometheus metrics to; disabled by default')
     args = parser.parse_args()
 
-    # logging
-    level = logging.INFO # logging.DEBUG # 
-    logging.basicConfig(level=level, format='%(relativeCreated)6d %(threadName)s %(levelname)s:%(message)s')
-
-    mypmb = PyPmb({"admin":"changeme"}, name="pmb", port=args.port, loop=asyncio.get_event_loop())
+    if args.workers > 1:
+        if not (hasattr(socket, 'SO_REUSEPORT') and hasattr(os, 'fork')):
+            parser.error("--workers needs SO_REUSEPORT and fork")
+        logging.basicConfig(level=logging.INFO, format='%(relativeCreated)6d %(process)d %(threadName)s %(levelname)s:%(message)s')
+        return supervise(args, args.workers)
 
-    loop = None #mypmb.loop
+    run(args)
 
-    # add target BMCs
-    mypmb.add_target(1, fakebmc.FakeBmc(mypmb.authdata, port=None))
-    #mypmb.add_target(2, Esp8266Bmc(mypmb.authdata, {}, {}, {'host':'192.168.1.11'}, {'host':'192.168.1.11'}, {'baud_rate':'38400'}, name="cloud1", port=None, loop=loop))
-    #mypmb.add_target(3, Esp8266WakeOnLanBmc(mypmb.authdata, {}, {}, {'host':'192.168.11.12'}, {'host':'192.168.1.12'}, {'baud_rate':'38400'}, {'mac':'AA:BB:CC:DD:EE:FF', 'ip':'192.168.1.255'}, name="cloud1", port=None, loop=loop)) 
-    
-    # setup
-    asyncbmc.wait_for_sync(mypmb.setup(), loop=mypmb.loop)
-
-    mypmb.listen()
 if __name__ == '__main__':
     sys.exit(main())
\ No newline at end of file
@@ -0,0 +1,340 @@
+#!/usr/bin/env python
+import logging
+import argparse
+import sys
+import os
+import asyncio
+import json
+import time
+import random
+import multiprocessing
+
+'''
+End to end load benchmark, PyPmb bridging N targets (FakeBmc and emulated ESP8266s) driven by concurrent IPMI LAN+ clients
+'''
+
+BENCH_CONFIG = {
+    "targets": [1, 4, 16],
+    "clients": [1, 4, 16],
+    "duration": 10,
+    "warmup": 2,
+    "ready_timeout": 60,
+    "esp8266_ratio": 0.5,
+    "control_ratio": 0.1,
+    "port": 16230,
+    "workers": 1,
+    "device_port": 12300,
+    "latency": 0,
+    "jitter": 0,
+    "drop_rate": 0,
+    "disconnect_rate": 0,
+    "userid": 'admin',
+    "password": 'changeme'
+}
+
+# no button press delays, chassis control should measure the bridge and not the sleeps
+BENCH_BUTTON_CONFIG = {
+    "power_off_press_duration": 0,
+    "power_on_press_duration": 0,
+    "power_cycle_off_press_duration": 0,
+    "power_cycle_wait_duration": 0,
+    "power_cycle_on_press_duration": 0,
+    "power_reset_press_duration": 0,
+    "power_shutdown_press_duration": 0,
+    "power_shutdown_wait_duration": 0,
+}
+
+# Chassis
+GET_CHASSIS_STATUS = 0x01
+CHASSIS_CONTROL = 0x02
+NODE_BUSY = 0xc0
+
+def get_device_ports(device_port, index):
+    # command port, uart bridge port
+    return device_port + 2 * index, device_port + 2 * index + 1
+
+def is_esp8266_target(index, esp8266_ratio):
+    # spread the emulated esp8266 targets evenly between the fake ones
+    return int((index + 1) * esp8266_ratio) > int(index * esp8266_ratio)
+
+def run_devices(count, device_port, faults):
+    logging.basicConfig(level=logging.WARNING)
+    from esp8266bmc import UART_CONFIG
+    from esp8266emulator import Esp8266Emulator
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    for index in range(count):
+        command_port, uart_port = get_device_ports(device_port, index)
+        # uart already set up the way the bmcs expect it
+        emulator = Esp8266Emulator(dict(faults, host='127.0.0.1', command_port=command_port, bridge_port=uart_port),
+                                   {key: UART_CONFIG[key] for key in ("baud_rate", "data_bits", "stop_bits", "parity")}, loop=loop)
+        loop.run_until_complete(emulator.start())
+    loop.run_forever()
+
+def run_bridge(port, targets, esp8266_ratio, device_port, userid, password, index=0, workers=1, sockets=None):
+    # readiness probes answered with node busy would flood warnings, FakeBmc prints to stdout where the report may go
+    logging.basicConfig(level=logging.ERROR)
+    sys.stdout = open(os.devnull, 'w')
+    import pyghmi.cmd.fakebmc as fakebmc
+    from pypmb import PyPmb
+    from esp8266bmc import Esp8266Bmc
+
+    if workers > 1:
+        # one of several workers sharing the port, it only builds the targets it owns
+        mypmb = PyPmb({userid: password}, name="bench-{}".format(index), port=None)
+        mypmb.share_port(port)
+        mypmb.set_shard(index, workers, sockets)
+    else:
+        mypmb = PyPmb({userid: password}, name="bench", port=port)
+    for target_index in range(targets):
+        if not mypmb.is_owner(target_index + 1):
+            continue
+        if is_esp8266_target(target_index, esp8266_ratio):
+            command_port, uart_port = get_device_ports(device_port, target_index)
+            target = Esp8266Bmc(mypmb.authdata, BENCH_BUTTON_CONFIG, {},
+                                {'host': '127.0.0.1', 'port': command_port, 'connection_timeout': 5},
+                                {'host': '127.0.0.1', 'port': uart_port, 'connection_timeout': 5},
+                                {'bridge_port': uart_port}, name="esp8266-{}".format(target_index + 1), port=None)
+        else:
+            target = fakebmc.FakeBmc(mypmb.authdata, port=None)
+        mypmb.add_target(target_index + 1, target)
+
+    mypmb.dispatch(mypmb.setup())
+    mypmb.listen()
+
+def wait_for_targets(ipmicmd, addrs, timeout):
+    # targets answer node busy until their setup is done
+    pending = set(addrs)
+    expiry = time.monotonic() + timeout
+    while pending and time.monotonic() < expiry:
+        for addr in list(pending):
+            try:
+                rsp = ipmicmd.raw_command(netfn=0, command=GET_CHASSIS_STATUS, bridge_request={'addr': addr, 'channel': 0})
+                if rsp.get('code', 0) != NODE_BUSY:
+                    pending.discard(addr)
+            except Exception:
+                pass
+        if pending:
+            time.sleep(0.5)
+    return not pending
+
+def run_client(index, port, addrs, config, barrier, results):
+    logging.basicConfig(level=logging.WARNING)
+    from pyghmi.ipmi import command
+
+    ipmicmd = command.Command(bmc='127.0.0.1', userid=config['userid'], password=config['password'], port=port)
+    is_ready = wait_for_targets(ipmicmd, addrs, config['ready_timeout'])
+    barrier.wait()
+
+    rng = random.Random(index)
+    latencies = {"status": [], "control": []}
+    errors = 0
+    start = time.monotonic() + config['warmup']
+    expiry = start + config['duration']
+    request = index
+    while is_ready and time.monotonic() < expiry:
+        addr = addrs[request % len(addrs)]
+        request += 1
+        kind = "control" if rng.random() < config['control_ratio'] else "status"
+        began = time.monotonic()
+        try:
+            if kind == "control":
+                # power on, a no-op once on
+                rsp = ipmicmd.raw_command(netfn=0, command=CHASSIS_CONTROL, data=[1], bridge_request={'addr': addr, 'channel': 0})
+            else:
+                rsp = ipmicmd.raw_command(netfn=0, command=GET_CHASSIS_STATUS, bridge_request={'addr': addr, 'channel': 0})
+            is_error = bool(rsp.get('code', 0))
+        except Exception:
+            is_error = True
+        if began >= start:
+            latencies[kind].append(time.monotonic() - began)
+            errors += is_error
+
+    results.put({"index": index, "ready": is_ready, "latencies": latencies, "errors": errors})
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+def summarize(latencies, duration):
+    return {
+        "requests": len(latencies),
+        "throughput": len(latencies) / duration,
+        "p50": percentile(latencies, 0.5),
+        "p99": percentile(latencies, 0.99),
+        "mean": sum(latencies) / len(latencies) if latencies else None
+    }
+
+def run_case(targets, clients, config):
+    context = multiprocessing.get_context('spawn')
+    port = config['port']
+    esp8266_count = sum(1 for index in range(targets) if is_esp8266_target(index, config['esp8266_ratio']))
+    processes = []
+    links = []
+    try:
+        if config['workers'] > 1:
+            from pypmb import create_shard_links
+            links = create_shard_links(config['workers'])
+        if esp8266_count:
+            faults = {key: config[key] for key in ("latency", "jitter", "drop_rate", "disconnect_rate")}
+            processes.append(context.Process(target=run_devices, args=(targets, config['device_port'], faults), daemon=True))
+        for index in range(config['workers']):
+            processes.append(context.Process(target=run_bridge, args=(port, targets, config['esp8266_ratio'], config['device_port'],
+                                                                      config['userid'], config['password'],
+                                                                      index, config['workers'], links[index] if links else None), daemon=True))
+        for process in processes:
+            process.start()
+
+        barrier = context.Barrier(clients)
+        results = context.Queue()
+        addrs = list(range(1, targets + 1))
+        client_processes = [context.Process(target=run_client, args=(index, port, addrs, config, barrier, results), daemon=True)
+                            for index in range(clients)]
+        for process in client_processes:
+            process.start()
+        processes.extend(client_processes)
+
+        client_results = [results.get(timeout=config['ready_timeout'] + config['warmup'] + config['duration'] + 30)
+                          for _ in client_processes]
+    finally:
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+            process.join(5)
+        for sockets in links:
+            for sock in sockets.values():
+                sock.close()
+
+    latencies = {"status": [], "control": []}
+    for result in client_results:
+        for kind, values in result['latencies'].items():
+            latencies[kind].extend(values)
+    all_latencies = latencies['status'] + latencies['control']
+
+    return {
+        "targets": targets,
+        "esp8266_targets": esp8266_count,
+        "clients": clients,
+        "workers": config['workers'],
+        "ready": all(result['ready'] for result in client_results),
+        "errors": sum(result['errors'] for result in client_results),
+        "all": summarize(all_latencies, config['duration']),
+        "status": summarize(latencies['status'], config['duration']),
+        "control": summarize(latencies['control'], config['duration'])
+    }
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog='pypmbbench',
+        description='Python Intelligent Platform Management Bridge load benchmark',
+        conflict_handler='resolve'
+    )
+    parser.add_argument('--targets',
+                        dest='targets',
+                        default=",".join(str(targets) for targets in BENCH_CONFIG['targets']),
+                        help='Comma separated bridged target counts; defaults to 1,4,16')
+    parser.add_argument('--clients',
+                        dest='clients',
+                        default=",".join(str(clients) for clients in BENCH_CONFIG['clients']),
+                        help='Comma separated concurrent client counts; defaults to 1,4,16')
+    parser.add_argument('--duration',
+                        dest='duration',
+                        type=float,
+                        default=BENCH_CONFIG['duration'],
+                        help='Measured seconds per case; defaults to 10')
+    parser.add_argument('--warmup',
+                        dest='warmup',
+                        type=float,
+                        default=BENCH_CONFIG['warmup'],
+                        help='Unmeasured seconds per case; defaults to 2')
+    parser.add_argument('--esp8266-ratio',
+                        dest='esp8266_ratio',
+                        type=float,
+                        default=BENCH_CONFIG['esp8266_ratio'],
+                        help='Share of targets backed by an emulated ESP8266, the rest are FakeBmc; defaults to 0.5')
+    parser.add_argument('--control-ratio',
+                        dest='control_ratio',
+                        type=float,
+                        default=BENCH_CONFIG['control_ratio'],
+                        help='Share of chassis control requests, the rest are chassis status; defaults to 0.1')
+    parser.add_argument('--port',
+                        dest='port',
+                        type=int,
+                        default=BENCH_CONFIG['port'],
+                        help='Port the bridge listens on; defaults to 16230')
+    parser.add_argument('--workers',
+                        dest='workers',
+                        type=int,
+                        default=BENCH_CONFIG['workers'],
+                        help='Bridge worker processes sharing the port with SO_REUSEPORT; defaults to 1')
+    parser.add_argument('--device-port',
+                        dest='device_port',
+                        type=int,
+                        default=BENCH_CONFIG['device_port'],
+                        help='First port of the emulated ESP8266s; defaults to 12300')
+    parser.add_argument('--latency',
+                        dest='latency',
+                        type=float,
+                        default=BENCH_CONFIG['latency'],
+                        help='Emulated ESP8266 command response latency in seconds; defaults to 0')
+    parser.add_argument('--jitter',
+                        dest='jitter',
+                        type=float,
+                        default=BENCH_CONFIG['jitter'],
+                        help='Emulated ESP8266 command response jitter in seconds; defaults to 0')
+    parser.add_argument('--drop-rate',
+                        dest='drop_rate',
+                        type=float,
+                        default=BENCH_CONFIG['drop_rate'],
+                        help='Probability an emulated ESP8266 drops a command response; defaults to 0')
+    parser.add_argument('--disconnect-rate',
+                        dest='disconnect_rate',
+                        type=float,
+                        default=BENCH_CONFIG['disconnect_rate'],
+                        help='Probability an emulated ESP8266 disconnects on a command; defaults to 0')
+    parser.add_argument('--output',
+                        dest='output',
+                        default=None,
+                        help='JSON results file; defaults to stdout')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(relativeCreated)6d %(threadName)s %(levelname)s:%(message)s')
+
+    config = dict(BENCH_CONFIG)
+    config.update({
+        "targets": [int(targets) for targets in args.targets.split(",")],
+        "clients": [int(clients) for clients in args.clients.split(",")],
+        "duration": args.duration,
+        "warmup": args.warmup,
+        "esp8266_ratio": args.esp8266_ratio,
+        "control_ratio": args.control_ratio,
+        "port": args.port,
+        "workers": args.workers,
+        "device_port": args.device_port,
+        "latency": args.latency,
+        "jitter": args.jitter,
+        "drop_rate": args.drop_rate,
+        "disconnect_rate": args.disconnect_rate
+    })
+
+    cases = []
+    for targets in config['targets']:
+        for clients in config['clients']:
+            logging.info("benchmarking %s targets with %s clients", targets, clients)
+            case = run_case(targets, clients, config)
+            logging.info("%s targets, %s clients: %.1f req/s, p50 %s, p99 %s, %s errors", targets, clients,
+                         case['all']['throughput'], case['all']['p50'], case['all']['p99'], case['errors'])
+            cases.append(case)
+
+    report = json.dumps({"config": config, "cases": cases}, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(report)
+    else:
+        print(report)
+
+if __name__ == '__main__':
+    sys.exit(main())
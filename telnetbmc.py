@@ -4,7 +4,10 @@ import argparse
 import sys
 import re
 import asyncio
+import time
+import threading
 import telnetlib3
+from collections import deque
 import commandbmc
 import asyncbmc
 import pinbmc
@@ -18,7 +21,15 @@ COMMAND_TELNET_CONFIG = {
     "crlf" : '\r\n',
     "response_timeout": 0.15, 
     "connection_timeout": 2.1,
-    "connection_retries": 1
+    "connection_retries": 1,
+    # seconds telnetlib3 waits for option negotiation on connect, the command port negotiates nothing
+    "connect_minwait": 0.1,
+    "binary": False,
+    # timeouts follow the measured round trip times of the host within (minimum, maximum), None to keep them fixed
+    "adaptive_timeouts": {
+        "response_timeout": (0.05, 2),
+        "connection_timeout": (0.5, 10)
+    }
 }
 
 SOL_TELNET_CONFIG = {
@@ -28,12 +39,17 @@ SOL_TELNET_CONFIG = {
     "crlf" : '\r\n',
     "response_timeout": 5,
     "connection_timeout": 2.1,
-    "connection_retries": 1
+    "connection_retries": 1,
+    "connect_minwait": 2.0,
+    "binary": True,
+    # console reads wait for output, not for responses
+    "adaptive_timeouts": None
 }
 
 # Receiver
 class TelnetSession(asyncbmc.AsyncSession):
-    def __init__(self, host, port, baud, crlf, response_timeout, connection_timeout = 3, connection_retries=1, name=None, loop=None):
+    def __init__(self, host, port, baud, crlf, response_timeout, connection_timeout = 3, connection_retries=1, binary=False, 
+                 adaptive_timeouts: dict = None, connect_minwait=2.0, name=None, loop=None):
         asyncbmc.AsyncSession.__init__(self, name=name, loop=loop)
         self.host = host
         self.port = port
@@ -42,6 +58,16 @@ class TelnetSession(asyncbmc.AsyncSession):
         self.response_timeout = response_timeout
         self.connection_timeout = connection_timeout
         self.connection_retries = connection_retries
+        self.connect_minwait = connect_minwait
+        # binary sessions read and write raw bytes, no codec on the serial path
+        self.binary = binary
+        # timeout bounds, the estimates are shared by all sessions to the host and port
+        self.adaptive_timeouts = adaptive_timeouts
+        self.response_rtt = asyncbmc.RttEstimator.get_estimator(host, port, 'response')
+        self.connection_rtt = asyncbmc.RttEstimator.get_estimator(host, port, 'connection')
+        self.write_time = None
+        # shared by every receiver of the session, a dead device fails fast
+        self.breaker = asyncbmc.AsyncCircuitBreaker(probe=self.probe, name="{}:{}".format(host, port), loop=self.loop)
 
         self.reader = None
         self.writer = None
@@ -49,6 +75,12 @@ class TelnetSession(asyncbmc.AsyncSession):
         self._waiter_connected = None
         self._waiter_closed = None
 
+        # a command exchange (write and its response lines) holds command_lock, sessions may be shared by many receivers
+        self.command_lock = asyncio.Lock(loop=self.loop)
+        self.connect_lock = asyncio.Lock(loop=self.loop)
+        # a device's one-exchange read of all its pins, shared by the pins read over this session
+        self.pin_snapshot = None
+
     async def is_connected(self):
         await asyncio.sleep(0, loop=self.loop)
         test1 = ((self._waiter_connected is not None and self._waiter_connected.done() and not self._waiter_connected.cancelled()) 
@@ -60,7 +92,46 @@ class TelnetSession(asyncbmc.AsyncSession):
         connected = test1 and test2
         return connected
 
-    async def connect(self):
+    def get_response_timeout(self):
+        if self.adaptive_timeouts is None:
+            return self.response_timeout
+        return self.response_rtt.get_timeout(self.response_timeout, *self.adaptive_timeouts['response_timeout'])
+
+    def get_connection_timeout(self):
+        if self.adaptive_timeouts is None:
+            return self.connection_timeout
+        return self.connection_rtt.get_timeout(self.connection_timeout, *self.adaptive_timeouts['connection_timeout'])
+
+    async def connect(self, connection_retries: int = None, connection_timeout: float = None):
+        if self.breaker.is_open():
+            return False
+        # one connection attempt at a time per session, retries and timeout can be overridden per call
+        is_connected = False
+        is_conclusive = True
+        try:
+            async with self.connect_lock:
+                is_connected, is_conclusive = await self._connect(connection_retries if connection_retries is not None else self.connection_retries,
+                                                                  connection_timeout if connection_timeout is not None else self.get_connection_timeout())
+        finally:
+            # refused or unreachable raises, it counts as a failure all the same
+            # attempts the retry budget prevented or cut short say nothing about the device
+            if is_conclusive:
+                self.record_connect(is_connected)
+        return is_connected
+
+    def record_connect(self, is_connected):
+        if is_connected:
+            self.breaker.record_success()
+        else:
+            self.breaker.record_failure()
+
+    async def probe(self):
+        # a single attempt while the breaker is half open
+        async with self.connect_lock:
+            is_connected, _ = await self._connect(1, self.get_connection_timeout())
+            return is_connected
+
+    async def _connect(self, connection_retries: int, connection_timeout: float):
         # https://telnetlib3.readthedocs.io/en/latest/intro.html
         # loop = asyncio.get_event_loop()
         # coro = telnetlib3.open_connection(self.telnet_host, self.telnet_port, shell=self.shell) # , loop=self.loop
@@ -72,35 +143,62 @@ class TelnetSession(asyncbmc.AsyncSession):
         #reader, writer = self.loop.run_until_complete(coro)
         #self.loop.run_until_complete(writer.protocol.waiter_closed)
         tries = 0
+        # connected, refused, or timed out within the full connection timeout
+        is_conclusive = False
 
-        while (not await self.is_connected() and tries < self.connection_retries):
+        while (not await self.is_connected() and tries < connection_retries):
+            # every attempt counts, reads and writes each reconnect through here
+            if not asyncbmc.RetryBudget.allow_retry('connect'):
+                break
+            timeout = asyncbmc.RetryBudget.get_timeout(connection_timeout)
+            if timeout <= 0:
+                break
             tries += 1
             self._waiter_connected = self.loop.create_future() #asyncio.Future()
             self._waiter_closed = self.loop.create_future() #asyncio.Future()
             # https://stackoverflow.com/questions/50678184/how-to-pass-additional-parameters-to-handle-client-coroutine
             # reader, writer = await telnetlib3.open_connection(self.telnet_host, self.telnet_port, shell=self.shell, loop=self.loop)
             
+            start = time.monotonic()
+            result = 'error'
             try:
                 #self.reader, self.writer = await telnetlib3.open_connection(self.host, self.port, loop=self.loop)
                 self.reader, self.writer = await asyncio.shield(asyncio.wait_for(telnetlib3.open_connection(self.host, self.port, 
                                                                                              waiter_closed=self._waiter_closed, 
                                                                                              _waiter_connected=self._waiter_connected, 
+                                                                                             encoding=False if self.binary else 'utf8',
+                                                                                             force_binary=self.binary,
+                                                                                             connect_minwait=self.connect_minwait,
                                                                                              loop=self.loop), 
-                                                                self.connection_timeout, 
+                                                                timeout, 
                                                                 loop=self.loop))
+                result = 'connected'
+                is_conclusive = True
+                self.connection_rtt.observe(time.monotonic() - start)
 
             except asyncio.TimeoutError as e:
             #except Exception as e:
                 # self._waiter_connected = None
                 # self._waiter_closed = None
-                logging.warning("Connection attempt {} timed out after {}s".format(tries, self.connection_timeout))
+                result = 'timeout'
+                if timeout >= connection_timeout:
+                    # only the estimate's own timeout says anything about the network, not one cut short by the retry budget
+                    is_conclusive = True
+                    self.connection_rtt.on_timeout()
+                logging.warning("Connection attempt {} timed out after {}s".format(tries, timeout))
+
+            finally:
+                metrics = asyncbmc.Metrics.get_metrics()
+                metrics.observe('asyncbmc_telnet_connect_seconds', time.monotonic() - start, {'host': self.host})
+                metrics.inc('asyncbmc_telnet_connect_attempts_total', {'host': self.host, 'result': result})
 
             #await self.shell(self.reader, self.writer)
             # coro = telnetlib3.open_connection(self.telnet_host, self.telnet_port, shell=self.shell, loop=self.loop)
             # task = asyncio.ensure_future(coro)  # asyncio.create_task(coro())  # 
             # reader, writer = await asyncio.wait({task}, loop = self.loop)
 
-        return tries < self.connection_retries
+        is_connected = await self.is_connected()
+        return is_connected, is_conclusive or is_connected
        
         
     async def disconnect(self):
@@ -122,28 +220,156 @@ class TelnetSession(asyncbmc.AsyncSession):
         is_connected = await self.connect()
         if is_connected:
             # print(command_text, end='', flush=True)
+            if self.binary and isinstance(command_text, str):
+                command_text = command_text.encode('utf8')
+            elif not self.binary and isinstance(command_text, (bytes, bytearray)):
+                command_text = bytes(command_text).decode('utf8')
+            if self.adaptive_timeouts is not None and self.write_time is None:
+                # a round trip runs from the first write to the next response
+                self.write_time = time.monotonic()
             self.writer.write(command_text)
             return await self.writer.drain()
 
-    async def read(self, num):
+    async def read(self, num, timeout=None):
         is_connected = await self.connect()
         if is_connected:
-            response_line = await asyncio.wait_for(self.reader.read(num), self.response_timeout, loop = self.loop)
+            if timeout is None:
+                timeout = self.get_response_timeout()
+            response_line = await self._wait_for_response(self.reader.read(num), timeout)
             # print(response_line, end='', flush=True)
             return response_line
 
     async def readline(self):
         is_connected = await self.connect()
         if is_connected:
-            response_line = await asyncio.wait_for(self.reader.readline(), self.response_timeout, loop = self.loop)
+            response_line = await self._wait_for_response(self.reader.readline(), self.get_response_timeout())
             # print(response_line, end='', flush=True)
             return response_line
 
+    async def discard_pending(self):
+        # unread input belongs to an exchange that already gave up on it, it must not be taken for the next response
+        if self.reader is not None and self.reader._buffer:
+            pending = await self.reader.read(len(self.reader._buffer))
+            logging.debug("discarded %r from host %s", pending, self.host)
+            asyncbmc.Metrics.get_metrics().inc('asyncbmc_telnet_discarded_total', {'host': self.host})
+
+    async def _wait_for_response(self, coro, timeout):
+        budget_timeout = asyncbmc.RetryBudget.get_timeout(timeout)
+        try:
+            response = await asyncio.wait_for(coro, budget_timeout, loop = self.loop)
+        except asyncio.TimeoutError:
+            if self.write_time is not None:
+                self.write_time = None
+                if budget_timeout >= timeout:
+                    self.response_rtt.on_timeout()
+            raise
+        if self.write_time is not None:
+            rtt = time.monotonic() - self.write_time
+            self.write_time = None
+            self.response_rtt.observe(rtt)
+            asyncbmc.Metrics.get_metrics().observe('asyncbmc_telnet_rtt_seconds', rtt, {'host': self.host})
+        return response
+
+class TelnetSessionPool(object):
+    # command sessions shared per device and loop, reference counted across the bmcs using them
+    _pool = None
+    _pool_lock = threading.Lock()
+
+    def __init__(self):
+        self.sessions: dict = {}
+        self.refcounts: dict = {}
+        self.lock = threading.Lock()
+
+    @classmethod
+    def get_pool(cls):
+        with cls._pool_lock:
+            if cls._pool is None:
+                cls._pool = cls()
+            return cls._pool
+
+    @staticmethod
+    def get_key(host, port, loop):
+        return (host, port, loop)
+
+    def acquire(self, host, port, baud, crlf, response_timeout, connection_timeout = 3, connection_retries=1, adaptive_timeouts: dict = None, 
+                connect_minwait=2.0, name=None, loop=None):
+        key = self.get_key(host, port, loop)
+        with self.lock:
+            session = self.sessions.get(key)
+            if session is None:
+                # the first bmc for a device decides its session settings
+                session = TelnetSession(host, port, baud, crlf, response_timeout, connection_timeout, connection_retries, 
+                                        adaptive_timeouts=adaptive_timeouts, connect_minwait=connect_minwait, name=name, loop=loop)
+                self.sessions[key] = session
+                self.refcounts[key] = 0
+            self.refcounts[key] += 1
+            logging.debug("acquired telnet session %s:%s, references %s", host, port, self.refcounts[key])
+        return session
+
+    async def release(self, session: TelnetSession):
+        key = self.get_key(session.host, session.port, session.loop)
+        with self.lock:
+            if self.sessions.get(key) is not session:
+                return
+            self.refcounts[key] -= 1
+            logging.debug("released telnet session %s:%s, references %s", session.host, session.port, self.refcounts[key])
+            if self.refcounts[key] > 0:
+                return
+            del self.sessions[key]
+            del self.refcounts[key]
+
+        # last reference, close the connection
+        session.breaker.reset()
+        if await session.is_connected():
+            await session.disconnect()
+
+    def is_shared(self, session: TelnetSession):
+        key = self.get_key(session.host, session.port, session.loop)
+        with self.lock:
+            return self.sessions.get(key) is session and self.refcounts[key] > 1
+
+    async def close_unshared(self, session: TelnetSession):
+        # close the connection of a holder's session, left alone while other bmcs on the device use it
+        if self.is_shared(session):
+            logging.debug("telnet session %s:%s is shared, keeping it connected", session.host, session.port)
+            return False
+        if await session.is_connected():
+            await session.disconnect()
+        return True
+
+class TelnetResponseMatcher(object):
+    # responses are matched on a bounded window of the newest lines, not the whole growing response
+    # pipelined responses end at a sentinel so only the newest line and its predecessor are examined
+    PIPELINED_WINDOW_LINES = 2
+    # longer than any response the devices send
+    MAX_LINES = 32
+
+    def __init__(self, window_lines: int = MAX_LINES, max_lines: int = MAX_LINES):
+        self.window = deque(maxlen=window_lines)
+        self.lines = deque(maxlen=max_lines)
+        self.line_count = 0
+
+    def feed(self, response_line):
+        self.window.append(response_line)
+        self.lines.append(response_line)
+        self.line_count += 1
+        return self.get_window_text()
+
+    def get_window_text(self):
+        return "".join(self.window)
+
+    def get_text(self):
+        # the last max_lines of the response, for logging
+        return "".join(self.lines)
+
 class TelnetCommand(commandbmc.GenericCommand):
     class CommandEnum(IntEnum):
         # Common
         KEEP_ALIVE    = 0x1000
 
+    # response to a keep alive, None if the device has no distinct one
+    SENTINEL_REGEX = None
+
     # https://stackoverflow.com/questions/33679930/how-to-extend-python-enum
     #CommandEnum = IntEnum('Idx', [(i.name, i.value) for i in chain(commandbmc.GenericCommand.CommandEnum, TelnetCommand.CommandEnum)])
 
@@ -154,7 +380,7 @@ class TelnetCommand(commandbmc.GenericCommand):
                 }
 
     def get_command_text(self, command_enum: CommandEnum = commandbmc.GenericCommand.CommandEnum.NONE):
-        commands = self.get_commands()
+        commands, _ = self.get_templates()
         return commands.get(command_enum)
 
     def get_responses(self):
@@ -164,9 +390,32 @@ class TelnetCommand(commandbmc.GenericCommand):
                 }
 
     def get_response_regex(self, command_enum: CommandEnum = commandbmc.GenericCommand.CommandEnum.NONE):
-        responses = self.get_responses()
+        _, responses = self.get_templates()
         return responses.get(command_enum)
 
+    def get_template_key(self):
+        # receiver state the command and response tables are built from
+        return type(self)
+
+    def compile_templates(self):
+        commands = self.get_commands()
+        responses = {command_enum: re.compile(response_regex) if response_regex is not None else None 
+                     for command_enum, response_regex in self.get_responses().items()}
+        return commands, responses
+
+    def get_templates(self):
+        # tables are built once per receiver and template key, i.e. pin logic level or uart parameters
+        templates = getattr(self.receiver, 'command_templates', None)
+        if templates is None:
+            return self.compile_templates()
+
+        template_key = self.get_template_key()
+        entry = templates.get(template_key)
+        if entry is None:
+            entry = self.compile_templates()
+            templates[template_key] = entry
+        return entry
+
     async def handle_response_match(self, match):
         if match:
             # handled   
@@ -180,28 +429,56 @@ class TelnetCommand(commandbmc.GenericCommand):
         if response_regex is None:
             response_regex = self.get_response_regex(command_enum)
 
-        match = re.search(response_regex, response_text)
+        if isinstance(response_regex, str):
+            response_regex = re.compile(response_regex)
+
+        match = response_regex.search(response_text)
 
         if match is not None or not response_text:
             if match is not None:    
                 await self.handle_response_match(match)
             else:
-                logging.warning("Unexpected blank response for command {}, expected '{}'".format(command_enum.name, response_regex))
+                logging.warning("Unexpected blank response for command {}, expected '{}'".format(command_enum.name, response_regex.pattern))
             return True
         else:
             # retry
             return False
 
-    async def execute(self):
+    def get_sentinel_regex(self):
+        # a keep alive marks the end of a pipelined response, it needs no marker itself
+        if self.command_enum == TelnetCommand.CommandEnum.KEEP_ALIVE:
+            return None
+        return self.SENTINEL_REGEX
+
+    async def send(self, pipelined: bool = False):
+        receiver: TelnetCommandReceiver = self.receiver
+        crlf = receiver.command_telnet_session.crlf
+        command_text = self.get_command_text(self.command_enum)
+        if pipelined and self.get_sentinel_regex() is not None:
+            # follow the command with a keep alive, its response ends the command's
+            command_text = "{}{}{}".format(command_text, crlf, self.get_command_text(TelnetCommand.CommandEnum.KEEP_ALIVE))
+        # send command
+        await receiver.command_telnet_session.write("{}{}".format(command_text, crlf))
+
+    async def skip_to_sentinel(self, sentinel_regex):
+        receiver: TelnetCommandReceiver = self.receiver
+        try:
+            while True:
+                response_line = await receiver.command_telnet_session.readline()
+                if not response_line or sentinel_regex.search(response_line):
+                    break
+        except asyncio.TimeoutError:
+            logging.debug("sentinel for host %s timed out", receiver.command_telnet_session.host)
+
+    async def receive(self, pipelined: bool = False):
         receiver: TelnetCommandReceiver = self.receiver
         command_enum = self.command_enum
         command_text = self.get_command_text(command_enum)
         response_regex = self.get_response_regex(command_enum)
-        response_text = ""
+        sentinel_regex = self.get_sentinel_regex() if pipelined else None
+        response_matcher = TelnetResponseMatcher(TelnetResponseMatcher.PIPELINED_WINDOW_LINES if pipelined else TelnetResponseMatcher.MAX_LINES)
         response_success = False
 
-        # send command
-        await receiver.command_telnet_session.write("{}{}".format(command_text, receiver.command_telnet_session.crlf))
         # get response
         while (True and not response_success):
             try:
@@ -214,19 +491,48 @@ class TelnetCommand(commandbmc.GenericCommand):
                 if not response_line:
                     # EOF
                     break
+                elif sentinel_regex is not None and sentinel_regex.search(response_line):
+                    # the response ended without a match
+                    sentinel_regex = None
+                    break
                 else:
-                    response_text += response_line
+                    response_text = response_matcher.feed(response_line)
                     response_success = await self.process_response_text(response_text, response_regex)
 
+            except asyncio.TimeoutError:
+                logging.debug("command %s timed out", command_enum.name)
+                asyncbmc.Metrics.get_metrics().inc('asyncbmc_telnet_timeouts_total', {'host': receiver.command_telnet_session.host})
+                break
             except Exception as e:
                 logging.error(e)
                 break
 
-        logging.debug("Command {}:\n\tEnum: {}\n\tText: {}\n\tResponse: {}\tRegex:{}"
-                      .format("Successful" if response_success else "Unsuccessful", command_enum.name, command_text, response_text, response_regex))
+        if response_success and sentinel_regex is not None:
+            # drop the rest of the response
+            await self.skip_to_sentinel(sentinel_regex)
+
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            logging.debug("command %s enum=%s text=%r response=%r regex=%r", "succeeded" if response_success else "failed",
+                          command_enum.name, command_text, response_matcher.get_text(), response_regex.pattern)
 
         return response_success
 
+    async def execute(self):
+        await self.send()
+        return await self.receive()
+
+    async def discard_pending(self):
+        receiver: TelnetCommandReceiver = self.receiver
+        await receiver.command_telnet_session.discard_pending()
+
+    def get_lock(self):
+        receiver: TelnetCommandReceiver = self.receiver
+        return getattr(receiver.command_telnet_session, "command_lock", None)
+
+    def get_target(self):
+        receiver: TelnetCommandReceiver = self.receiver
+        return receiver.command_telnet_session.host
+
 
 class TelnetPinCommand(TelnetCommand, commandbmc.PinCommand):
     class CommandEnum(IntEnum):
@@ -253,6 +559,8 @@ class TelnetSerialCommand(TelnetCommand, commandbmc.SerialCommand):
 class TelnetCommandReceiver(object):
     def __init__(self, command_telnet_session: TelnetSession):
         self.command_telnet_session = command_telnet_session
+        # template key -> (command texts, compiled response patterns), the key covers every setting the tables depend on
+        self.command_templates: dict = {}
 
 class TelnetCommandPin(TelnetCommandReceiver, commandbmc.CommandPin):
     def __init__(self, pin_command_telnet_session: TelnetSession, pin: int, is_output: bool = True, value: bool = False, invert_logic: bool = False, loop=None):
@@ -281,6 +589,8 @@ class TelnetBmc(commandbmc.CommandBmc):
         self.command_telnet_response_timeout = self.command_telnet_config['response_timeout']
         self.command_telnet_connection_timeout = self.command_telnet_config['connection_timeout']
         self.command_telnet_connection_retries = self.command_telnet_config['connection_retries']
+        self.command_telnet_adaptive_timeouts = self.command_telnet_config['adaptive_timeouts']
+        self.command_telnet_connect_minwait = self.command_telnet_config['connect_minwait']
 
         self.command_telnet_session = None 
 
@@ -296,25 +606,50 @@ class TelnetBmc(commandbmc.CommandBmc):
         self.sol_telnet_response_timeout = self.sol_telnet_config['response_timeout']
         self.sol_telnet_connection_timeout = self.sol_telnet_config['connection_timeout']
         self.sol_telnet_connection_retries = self.sol_telnet_config['connection_retries']
+        self.sol_telnet_binary = self.sol_telnet_config['binary']
+        self.sol_telnet_adaptive_timeouts = self.sol_telnet_config['adaptive_timeouts']
+        self.sol_telnet_connect_minwait = self.sol_telnet_config['connect_minwait']
 
     async def setup_command_telnet_session(self):
-        await asyncio.sleep(0, loop=self.loop)
-        self.command_telnet_session = TelnetSession(self.command_telnet_host, self.command_telnet_port, 
-                                                    self.command_telnet_baud, self.command_telnet_crlf, 
-                                                    self.command_telnet_response_timeout, self.command_telnet_connection_timeout, 
-                                                    self.command_telnet_connection_retries, loop=self.loop)
+        await self.release_command_telnet_session()
+        # one pooled connection per device, shared by every bmc driving its pins
+        self.command_telnet_session = TelnetSessionPool.get_pool().acquire(self.command_telnet_host, self.command_telnet_port, 
+                                                                           self.command_telnet_baud, self.command_telnet_crlf, 
+                                                                           self.command_telnet_response_timeout, self.command_telnet_connection_timeout, 
+                                                                           self.command_telnet_connection_retries, 
+                                                                           adaptive_timeouts=self.command_telnet_adaptive_timeouts, 
+                                                                           connect_minwait=self.command_telnet_connect_minwait, loop=self.loop)
+
+    async def release_command_telnet_session(self):
+        if self.command_telnet_session is not None:
+            await TelnetSessionPool.get_pool().release(self.command_telnet_session)
+            self.command_telnet_session = None
 
     async def setup_serial_session(self):
         await asyncio.sleep(0, loop=self.loop)
+        if self.serial_session is not None:
+            # stop probing for the session being replaced
+            self.serial_session.breaker.reset()
         self.serial_session = TelnetSession(self.sol_telnet_host, self.sol_telnet_port, 
                                             self.sol_telnet_baud, self.sol_telnet_crlf,
                                             self.sol_telnet_response_timeout, self.sol_telnet_connection_timeout, 
-                                            self.sol_telnet_connection_retries, loop=self.loop)
+                                            self.sol_telnet_connection_retries, binary=self.sol_telnet_binary, 
+                                            adaptive_timeouts=self.sol_telnet_adaptive_timeouts, 
+                                            connect_minwait=self.sol_telnet_connect_minwait, loop=self.loop)
+
+    def is_available(self):
+        return self.command_telnet_session is None or not self.command_telnet_session.breaker.is_open()
 
     async def setup(self):
         await self.setup_command_telnet_session()
         await self.setup_serial_session()
         return await super().setup()
+
+    async def teardown(self):
+        await super().teardown()
+        await self.release_command_telnet_session()
+        if self.serial_session is not None:
+            self.serial_session.breaker.reset()
     
 def main():
     parser = argparse.ArgumentParser(
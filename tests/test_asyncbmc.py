@@ -0,0 +1,331 @@
+import asyncio
+import time
+import unittest
+import asyncbmc
+
+
+class AsyncTestCase(unittest.TestCase):
+    # every test gets its own loop, objects under test are created with loop=self.loop
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        # probes, servers' client handlers and the like are left running by some tests
+        pending = asyncio.all_tasks(loop=self.loop)
+        for task in pending:
+            task.cancel()
+        self.loop.run_until_complete(asyncio.gather(*pending, loop=self.loop, return_exceptions=True))
+        self.loop.close()
+        asyncbmc.RetryBudget.set_current(None)
+
+    def run_async(self, coro, timeout=5):
+        return self.loop.run_until_complete(asyncio.wait_for(coro, timeout, loop=self.loop))
+
+
+class RetryBudgetTest(AsyncTestCase):
+    def test_retries_run_out(self):
+        budget = asyncbmc.RetryBudget(retries=2, deadline=10)
+        self.assertTrue(budget.try_retry())
+        self.assertTrue(budget.try_retry())
+        self.assertFalse(budget.try_retry())
+
+    def test_deadline_ends_retries(self):
+        budget = asyncbmc.RetryBudget(retries=4, deadline=0)
+        self.assertEqual(budget.remaining_time(), 0)
+        self.assertFalse(budget.try_retry())
+        self.assertEqual(budget.retries, 4)
+
+    def test_no_budget_allows_everything(self):
+        asyncbmc.RetryBudget.set_current(None)
+        self.assertTrue(asyncbmc.RetryBudget.allow_retry('test'))
+        self.assertEqual(asyncbmc.RetryBudget.get_timeout(3), 3)
+
+    def test_timeout_ends_with_deadline(self):
+        asyncbmc.RetryBudget.set_current(asyncbmc.RetryBudget(retries=4, deadline=0.5))
+        self.assertLessEqual(asyncbmc.RetryBudget.get_timeout(3), 0.5)
+        self.assertEqual(asyncbmc.RetryBudget.get_timeout(0.1), 0.1)
+
+    def test_allow_retry_consumes_current(self):
+        asyncbmc.RetryBudget.set_current(asyncbmc.RetryBudget(retries=1, deadline=10))
+        self.assertTrue(asyncbmc.RetryBudget.allow_retry('test'))
+        self.assertFalse(asyncbmc.RetryBudget.allow_retry('test'))
+
+    def test_budget_is_per_task(self):
+        async def request(retries):
+            asyncbmc.RetryBudget.set_current(asyncbmc.RetryBudget(retries=retries, deadline=10))
+            await asyncio.sleep(0, loop=self.loop)
+            allowed = 0
+            while asyncbmc.RetryBudget.allow_retry('test'):
+                allowed += 1
+                await asyncio.sleep(0, loop=self.loop)
+            return allowed
+
+        results = self.run_async(asyncio.gather(request(1), request(3), loop=self.loop))
+        self.assertEqual(results, [1, 3])
+        self.assertIsNone(asyncbmc.RetryBudget.get_current())
+
+
+class RttEstimatorTest(unittest.TestCase):
+    def test_default_until_sampled(self):
+        estimator = asyncbmc.RttEstimator()
+        self.assertEqual(estimator.get_timeout(3, 0.5, 10), 3)
+
+    def test_timeout_follows_samples_within_bounds(self):
+        estimator = asyncbmc.RttEstimator()
+        for _ in range(20):
+            estimator.observe(0.2)
+        self.assertAlmostEqual(estimator.srtt, 0.2)
+        self.assertEqual(estimator.get_timeout(3, 0.5, 10), 0.5)
+        for _ in range(20):
+            estimator.observe(30)
+        self.assertEqual(estimator.get_timeout(3, 0.5, 10), 10)
+
+    def test_timeouts_back_off_until_next_sample(self):
+        estimator = asyncbmc.RttEstimator()
+        estimator.observe(1)
+        timeout = estimator.get_timeout(3, 0.1, 100)
+        estimator.on_timeout()
+        estimator.on_timeout()
+        self.assertAlmostEqual(estimator.get_timeout(3, 0.1, 100), timeout * 4)
+        estimator.observe(1)
+        self.assertEqual(estimator.backoff, 1)
+
+
+class AsyncCircuitBreakerTest(AsyncTestCase):
+    def create_breaker(self, probe=None):
+        return asyncbmc.AsyncCircuitBreaker(probe=probe, config={'failure_threshold': 3, 'backoff': 0.01, 'max_backoff': 0.05, 'jitter': 0},
+                                            name='test', loop=self.loop)
+
+    def test_trips_after_threshold(self):
+        breaker = self.create_breaker()
+        breaker.record_failure()
+        breaker.record_failure()
+        self.assertFalse(breaker.is_open())
+        breaker.record_failure()
+        self.assertTrue(breaker.is_open())
+        self.assertEqual(breaker.state, asyncbmc.AsyncCircuitBreaker.State.OPEN)
+
+    def test_success_clears_failures(self):
+        breaker = self.create_breaker()
+        breaker.record_failure()
+        breaker.record_failure()
+        breaker.record_success()
+        breaker.record_failure()
+        self.assertFalse(breaker.is_open())
+
+    def test_probe_closes_once_reachable(self):
+        probe_states = []
+
+        async def probe():
+            probe_states.append(breaker.state)
+            return len(probe_states) >= 3
+
+        async def trip():
+            for _ in range(3):
+                breaker.record_failure()
+            while breaker.is_open():
+                await asyncio.sleep(0.01, loop=self.loop)
+
+        breaker = self.create_breaker(probe)
+        self.run_async(trip())
+        # only the probe runs half open, failed probes open the breaker again
+        self.assertEqual(probe_states, [asyncbmc.AsyncCircuitBreaker.State.HALF_OPEN] * 3)
+        self.assertEqual(breaker.state, asyncbmc.AsyncCircuitBreaker.State.CLOSED)
+        self.assertEqual(breaker.failures, 0)
+        self.assertFalse(breaker.is_probing())
+
+    def test_backoff_doubles_per_open(self):
+        breaker = self.create_breaker()
+        breaker.opens = 1
+        self.assertAlmostEqual(breaker.get_backoff(), 0.01)
+        breaker.opens = 2
+        self.assertAlmostEqual(breaker.get_backoff(), 0.02)
+        breaker.opens = 10
+        self.assertAlmostEqual(breaker.get_backoff(), 0.05)
+
+    def test_probe_runs_without_request_budget(self):
+        budgets = []
+
+        async def probe():
+            budgets.append(asyncbmc.RetryBudget.get_current())
+            return True
+
+        async def trip():
+            # the request that trips the breaker has spent its budget, the probe must not inherit it
+            asyncbmc.RetryBudget.set_current(asyncbmc.RetryBudget(retries=0, deadline=0))
+            for _ in range(3):
+                breaker.record_failure()
+            await breaker.probe_task
+
+        breaker = self.create_breaker(probe)
+        self.run_async(trip())
+        self.assertEqual(budgets, [None])
+        self.assertFalse(breaker.is_open())
+
+    def test_reset_cancels_probe(self):
+        async def probe():
+            return False
+
+        async def trip():
+            for _ in range(3):
+                breaker.record_failure()
+            probe_task = breaker.probe_task
+            breaker.reset()
+            await asyncio.sleep(0, loop=self.loop)
+            return probe_task
+
+        breaker = self.create_breaker(probe)
+        probe_task = self.run_async(trip())
+        self.assertTrue(probe_task.cancelled())
+        self.assertEqual(breaker.state, asyncbmc.AsyncCircuitBreaker.State.CLOSED)
+
+
+class AsyncSchedulerTest(AsyncTestCase):
+    def setUp(self):
+        AsyncTestCase.setUp(self)
+        self.scheduler = asyncbmc.AsyncScheduler(name='test', loop=self.loop)
+
+    def tearDown(self):
+        self.scheduler.stop()
+        self.loop.run_until_complete(asyncio.sleep(0, loop=self.loop))
+        AsyncTestCase.tearDown(self)
+
+    def test_runs_most_urgent_first(self):
+        order = []
+        release = asyncio.Event(loop=self.loop)
+
+        async def blocker():
+            await release.wait()
+
+        async def operation(name):
+            order.append(name)
+
+        async def submit_all():
+            Priority = asyncbmc.AsyncScheduler.Priority
+            running = asyncio.ensure_future(self.scheduler.submit(Priority.MAINTENANCE, blocker), loop=self.loop)
+            await asyncio.sleep(0, loop=self.loop)
+            queued = [asyncio.ensure_future(self.scheduler.submit(priority, operation, priority.name), loop=self.loop)
+                      for priority in (Priority.BACKGROUND, Priority.STATUS, Priority.MAINTENANCE, Priority.POWER, Priority.STATUS)]
+            await asyncio.sleep(0, loop=self.loop)
+            release.set()
+            await asyncio.gather(running, *queued, loop=self.loop)
+
+        self.run_async(submit_all())
+        self.assertEqual(order, ['POWER', 'STATUS', 'STATUS', 'MAINTENANCE', 'BACKGROUND'])
+
+    def test_coalesces_queued_operations_with_a_key(self):
+        calls = []
+        release = asyncio.Event(loop=self.loop)
+
+        async def blocker():
+            await release.wait()
+
+        async def read():
+            calls.append(len(calls))
+            return len(calls)
+
+        async def submit_all():
+            Priority = asyncbmc.AsyncScheduler.Priority
+            running = asyncio.ensure_future(self.scheduler.submit(Priority.POWER, blocker), loop=self.loop)
+            await asyncio.sleep(0, loop=self.loop)
+            reads = [asyncio.ensure_future(self.scheduler.submit(Priority.STATUS, read, key='read'), loop=self.loop) for _ in range(5)]
+            await asyncio.sleep(0, loop=self.loop)
+            release.set()
+            await running
+            results = await asyncio.gather(*reads, loop=self.loop)
+            # once the coalesced read has run, a new one is queued again
+            results.append(await self.scheduler.submit(Priority.STATUS, read, key='read'))
+            return results
+
+        results = self.run_async(submit_all())
+        self.assertEqual(results, [1, 1, 1, 1, 1, 2])
+        self.assertEqual(len(calls), 2)
+
+    def test_nested_submit_runs_inline(self):
+        async def read():
+            return 'on'
+
+        async def power_action():
+            # reading back the state from inside the running operation must not wait behind itself
+            return await self.scheduler.submit(asyncbmc.AsyncScheduler.Priority.STATUS, read, key='read')
+
+        result = self.run_async(self.scheduler.submit(asyncbmc.AsyncScheduler.Priority.POWER, power_action), timeout=1)
+        self.assertEqual(result, 'on')
+
+    def test_operation_runs_in_submitter_context(self):
+        async def operation():
+            return asyncbmc.RetryBudget.get_current()
+
+        async def request():
+            budget = asyncbmc.RetryBudget(retries=2, deadline=10)
+            asyncbmc.RetryBudget.set_current(budget)
+            return budget, await self.scheduler.submit(asyncbmc.AsyncScheduler.Priority.STATUS, operation)
+
+        budget, seen = self.run_async(request())
+        self.assertIs(seen, budget)
+
+    def test_exception_reaches_submitter(self):
+        async def fail():
+            raise IOError('unreachable')
+
+        async def read():
+            return True
+
+        with self.assertRaises(IOError):
+            self.run_async(self.scheduler.submit(asyncbmc.AsyncScheduler.Priority.STATUS, fail))
+        # the worker keeps serving
+        self.assertTrue(self.run_async(self.scheduler.submit(asyncbmc.AsyncScheduler.Priority.STATUS, read)))
+
+    def test_stop_cancels_queued(self):
+        release = asyncio.Event(loop=self.loop)
+
+        async def blocker():
+            await release.wait()
+
+        async def submit_and_stop():
+            Priority = asyncbmc.AsyncScheduler.Priority
+            running = asyncio.ensure_future(self.scheduler.submit(Priority.POWER, blocker), loop=self.loop)
+            await asyncio.sleep(0, loop=self.loop)
+            queued = asyncio.ensure_future(self.scheduler.submit(Priority.STATUS, blocker, key='read'), loop=self.loop)
+            await asyncio.sleep(0, loop=self.loop)
+            self.scheduler.stop()
+            return await asyncio.gather(running, queued, loop=self.loop, return_exceptions=True)
+
+        results = self.run_async(submit_and_stop())
+        self.assertTrue(all(isinstance(result, asyncio.CancelledError) for result in results))
+        self.assertEqual(self.scheduler.queued, {})
+
+
+class AsyncCachedStatusTest(AsyncTestCase):
+    class CountingStatus(asyncbmc.AsyncStatus):
+        def __init__(self, loop=None):
+            asyncbmc.AsyncStatus.__init__(self, loop=loop)
+            self.reads = 0
+
+        async def get_value(self):
+            self.reads += 1
+            self.value = not self.value
+            return self.value
+
+    def test_served_from_cache_until_invalidated(self):
+        status = AsyncCachedStatusTest.CountingStatus(loop=self.loop)
+        cache = asyncbmc.AsyncCachedStatus(status, ttl=5, loop=self.loop)
+        self.assertTrue(self.run_async(cache.get_value()))
+        self.assertTrue(self.run_async(cache.get_value()))
+        self.assertEqual(status.reads, 1)
+        cache.invalidate()
+        self.assertTrue(cache.is_stale())
+        self.assertFalse(self.run_async(cache.get_value()))
+        self.assertEqual(status.reads, 2)
+
+    def test_stale_after_ttl(self):
+        status = AsyncCachedStatusTest.CountingStatus(loop=self.loop)
+        cache = asyncbmc.AsyncCachedStatus(status, ttl=0.05, loop=self.loop)
+        self.run_async(cache.get_value())
+        self.assertFalse(cache.is_stale())
+        time.sleep(0.1)
+        self.assertTrue(cache.is_stale())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,85 @@
+import unittest
+import commandbmc
+import telnetbmc
+import esp8266bmc
+import esp8266emulator
+from esp8266emulator import Esp8266Emulator
+from tests.test_asyncbmc import AsyncTestCase
+from tests.test_telnetbmc import get_free_port
+
+
+class Esp8266EmulatedTestCase(AsyncTestCase):
+    # input pins on one command session of an emulated device
+    PINS = (2, 4, 5)
+
+    def setUp(self):
+        AsyncTestCase.setUp(self)
+        port = get_free_port()
+        self.emulator = Esp8266Emulator({'host': '127.0.0.1', 'command_port': port, 'bridge_port': get_free_port()}, None, loop=self.loop)
+        self.run_async(self.emulator.start())
+        self.session = telnetbmc.TelnetSession('127.0.0.1', port, 115200, '\r\n', 1, connection_timeout=1, connection_retries=1,
+                                               connect_minwait=0.05, loop=self.loop)
+        self.pins = [esp8266bmc.Esp8266TelnetCommandPin(self.session, pin, False, False, False, loop=self.loop) for pin in self.PINS]
+        for pin in self.pins:
+            self.run_async(pin.setup())
+
+    def tearDown(self):
+        self.run_async(self.session.disconnect())
+        self.run_async(self.emulator.stop())
+        AsyncTestCase.tearDown(self)
+
+    def set_levels(self, *levels):
+        for pin, level in zip(self.PINS, levels):
+            self.emulator.pins[pin]['level'] = level
+
+
+class PipelinedReadTest(Esp8266EmulatedTestCase):
+    def read_pipelined(self):
+        invoker = commandbmc.CommandInvoker(retries=1, pipelined=True, loop=self.loop)
+        commands = [esp8266bmc.Esp8266TelnetPinCommand(pin, commandbmc.PinCommand.CommandEnum.READ_STATE, loop=self.loop) for pin in self.pins]
+        return self.run_async(invoker.invoke(*commands))
+
+    def test_responses_match_their_own_commands(self):
+        for levels in ((1, 0, 1), (0, 1, 0), (1, 1, 0)):
+            self.set_levels(*levels)
+            self.assertTrue(self.read_pipelined())
+            self.assertEqual(tuple(pin.logic_level for pin in self.pins), levels)
+
+    def test_next_command_sees_no_leftovers(self):
+        self.set_levels(1, 1, 1)
+        self.assertTrue(self.read_pipelined())
+        invoker = commandbmc.CommandInvoker(retries=1, loop=self.loop)
+        self.set_levels(0, 0, 0)
+        self.assertTrue(self.run_async(invoker.invoke(esp8266bmc.Esp8266TelnetPinCommand(self.pins[0], commandbmc.PinCommand.CommandEnum.READ_STATE,
+                                                                                          loop=self.loop))))
+        self.assertEqual(self.pins[0].logic_level, 0)
+
+
+class Esp8266PinSnapshotTest(Esp8266EmulatedTestCase):
+    def test_shared_by_the_session(self):
+        snapshot = esp8266bmc.Esp8266PinSnapshot.get_snapshot(self.session)
+        self.assertIs(self.session.pin_snapshot, snapshot)
+        self.assertTrue(snapshot.is_shared())
+
+    def test_reads_every_listed_pin(self):
+        snapshot = self.session.pin_snapshot
+        self.set_levels(1, 0, 1)
+        self.assertTrue(self.run_async(snapshot.read()))
+        # the uart pins aren't digital and aren't part of it
+        self.assertEqual(set(snapshot.states), {pin for pin in esp8266emulator.GPIO_PINS if self.emulator.pins[pin]['mode'] != 'uart'})
+        self.assertEqual([snapshot.states[pin] for pin in self.PINS], ['on', 'off', 'on'])
+        self.assertEqual([pin.logic_level for pin in self.pins], [1, 0, 1])
+
+    def test_read_through_snapshot_then_single_pin(self):
+        self.set_levels(0, 1, 0)
+        self.assertFalse(self.run_async(self.pins[0].get_value()))
+        self.assertTrue(self.run_async(self.pins[1].get_value()))
+        # the dump is read up to its end, a single read after it gets its own response
+        invoker = commandbmc.CommandInvoker(retries=1, loop=self.loop)
+        self.assertTrue(self.run_async(invoker.invoke(esp8266bmc.Esp8266TelnetPinCommand(self.pins[2], commandbmc.PinCommand.CommandEnum.READ_STATE,
+                                                                                          loop=self.loop))))
+        self.assertEqual(self.pins[2].logic_level, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,96 @@
+import asyncio
+import socket
+import unittest
+import asyncbmc
+import telnetbmc
+from tests.test_asyncbmc import AsyncTestCase
+
+
+def get_free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+class TelnetSessionConnectTest(AsyncTestCase):
+    def setUp(self):
+        AsyncTestCase.setUp(self)
+        self.server = None
+
+    def tearDown(self):
+        if self.server is not None:
+            self.server.close()
+            self.loop.run_until_complete(self.server.wait_closed())
+        AsyncTestCase.tearDown(self)
+
+    def create_session(self, port, connection_timeout=3):
+        session = telnetbmc.TelnetSession('127.0.0.1', port, 115200, '\r\n', 1, connection_timeout=connection_timeout, connection_retries=1,
+                                          loop=self.loop)
+        session.breaker.config.update({'failure_threshold': 3, 'backoff': 60, 'jitter': 0})
+        return session
+
+    def start_silent_server(self):
+        # accepts and never negotiates, connection attempts time out
+        async def handle_client(reader, writer):
+            await reader.read()
+            writer.close()
+
+        port = get_free_port()
+        self.server = self.run_async(asyncio.start_server(handle_client, '127.0.0.1', port, loop=self.loop))
+        return port
+
+    def test_refused_connections_open_the_breaker(self):
+        session = self.create_session(get_free_port())
+        for _ in range(3):
+            with self.assertRaises(OSError):
+                self.run_async(session.connect())
+        self.assertTrue(session.breaker.is_open())
+        # failed fast, no attempt is made
+        self.assertFalse(self.run_async(session.connect(), timeout=0.5))
+        session.breaker.reset()
+
+    def test_spent_budget_is_not_a_failure(self):
+        session = self.create_session(get_free_port())
+
+        async def request():
+            asyncbmc.RetryBudget.set_current(asyncbmc.RetryBudget(retries=0, deadline=10))
+            return await session.connect()
+
+        for _ in range(3):
+            self.assertFalse(self.run_async(request()))
+        self.assertEqual(session.breaker.failures, 0)
+        self.assertFalse(session.breaker.is_open())
+
+    def test_timeout_cut_short_by_budget_is_not_a_failure(self):
+        session = self.create_session(self.start_silent_server(), connection_timeout=3)
+
+        async def request():
+            asyncbmc.RetryBudget.set_current(asyncbmc.RetryBudget(retries=4, deadline=0.2))
+            return await session.connect()
+
+        self.assertFalse(self.run_async(request()))
+        self.assertEqual(session.breaker.failures, 0)
+
+    def test_full_timeout_is_a_failure(self):
+        session = self.create_session(self.start_silent_server(), connection_timeout=0.2)
+        self.assertFalse(self.run_async(session.connect()))
+        self.assertEqual(session.breaker.failures, 1)
+
+
+class TelnetResponseMatcherTest(unittest.TestCase):
+    def test_pipelined_window_holds_newest_lines(self):
+        matcher = telnetbmc.TelnetResponseMatcher(telnetbmc.TelnetResponseMatcher.PIPELINED_WINDOW_LINES)
+        matcher.feed("a\n")
+        matcher.feed("b\n")
+        self.assertEqual(matcher.feed("c\n"), "b\nc\n")
+        self.assertEqual(matcher.get_text(), "a\nb\nc\n")
+
+    def test_default_window_holds_whole_response(self):
+        matcher = telnetbmc.TelnetResponseMatcher()
+        for line in ("a\n", "b\n", "c\n"):
+            text = matcher.feed(line)
+        self.assertEqual(text, "a\nb\nc\n")
+
+
+if __name__ == '__main__':
+    unittest.main()